@@ -8,19 +8,20 @@ from wizard import (
     SuccessStart, ExportDataWizardConfigure, ExportDataWizard,
 )
 from channel import Channel, MagentoTier
-from party import Party, MagentoWebsiteParty, Address
+from party import Party, MagentoWebsiteParty, Address, ContactMechanism
 from product import (
     Category, MagentoInstanceCategory, Product,
-    ProductPriceTier, ProductSaleChannelListing
+    ProductPriceTier, ProductSaleChannelListing, PriceListLine
 )
 from country import Country, Subdivision
 from currency import Currency
 from carrier import SaleChannelCarrier
 from sale import (
-    Sale, StockShipmentOut, SaleLine
+    Sale, StockShipmentOut, SaleLine, MagentoOrderCache, MagentoOrderArchive
 )
 from bom import BOM
 from payment import MagentoPaymentGateway, Payment
+from stock import StockMove
 
 
 def register():
@@ -45,17 +46,22 @@ def register():
         MagentoInstanceCategory,
         Product,
         ProductPriceTier,
+        PriceListLine,
         ExportDataWizardConfigure,
         StockShipmentOut,
         Address,
+        ContactMechanism,
         Currency,
         Sale,
         SaleChannelCarrier,
         SaleLine,
+        MagentoOrderCache,
+        MagentoOrderArchive,
         BOM,
         ProductSaleChannelListing,
         MagentoPaymentGateway,
         Payment,
+        StockMove,
         module='magento', type_='model'
     )
     Pool.register(
@@ -1,7 +1,65 @@
 # -*- coding: utf-8 -*-
+from multiprocessing.pool import ThreadPool
+
 from magento.api import API
 
 
+def map_concurrently(func, items, concurrency=1):
+    """
+    Same as map, but calls func on the items from at most `concurrency`
+    threads at the same time.
+
+    The threads have no transaction, so func must not access the database.
+
+    :param func: Function to call on each item
+    :param items: List of items
+    :param concurrency: Maximum number of threads to use
+    :return: List of results in the order of the items
+    """
+    concurrency = min(concurrency or 1, len(items))
+    if concurrency <= 1:
+        return map(func, items)
+
+    pool = ThreadPool(concurrency)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def call_concurrently(api_factory, func, batches, concurrency=1):
+    """
+    Call func(api, batch) for each batch using at most `concurrency`
+    API sessions in parallel. Each session is opened once with api_factory
+    and reused for all the batches it is given.
+
+    The threads have no transaction, so func must not access the database.
+
+    :param api_factory: Callable returning a new (not entered) API instance
+    :param func: Function to call with an API session and a batch
+    :param batches: List of batches
+    :param concurrency: Maximum number of API sessions to use
+    :return: List of results in the order of the batches
+    """
+    if not batches:
+        return []
+
+    concurrency = max(1, min(concurrency or 1, len(batches)))
+    results = [None] * len(batches)
+
+    def work(indices):
+        with api_factory() as api:
+            for index in indices:
+                results[index] = func(api, batches[index])
+
+    map_concurrently(work, [
+        range(start, len(batches), concurrency)
+        for start in range(concurrency)
+    ], concurrency)
+    return results
+
+
 class Core(API):
     """
     This API extends the API for the custom API implementation
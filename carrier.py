@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from trytond.pool import PoolMeta
+from trytond.cache import Cache
 
 
 __metaclass__ = PoolMeta
@@ -11,6 +12,46 @@ __all__ = [
 class SaleChannelCarrier:
     __name__ = 'sale.channel.carrier'
 
+    #: Maps the channel id to the carrier ids by code
+    _magento_carriers_cache = Cache(
+        'sale.channel.carrier.magento_carriers', context=False
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(SaleChannelCarrier, cls).create(vlist)
+        cls._magento_carriers_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(SaleChannelCarrier, cls).write(*args)
+        cls._magento_carriers_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super(SaleChannelCarrier, cls).delete(records)
+        cls._magento_carriers_cache.clear()
+
+    @classmethod
+    def get_magento_carriers(cls, channel_id):
+        """
+        Return the carriers of the channel by code. They are loaded once and
+        cached until a channel carrier is changed.
+
+        :param channel_id: ID of the channel
+        :return: Dictionary mapping code to carrier ID, or None if the code
+                 is not mapped to a carrier
+        """
+        carriers = cls._magento_carriers_cache.get(channel_id)
+        if carriers is None:
+            carriers = dict(
+                (record.code, record.carrier and record.carrier.id or None)
+                for record in cls.search([('channel', '=', channel_id)])
+            )
+            cls._magento_carriers_cache.set(channel_id, carriers)
+        return carriers
+
     def get_magento_mapping(self):
         """
         Return code and title for magento
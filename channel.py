@@ -4,14 +4,22 @@ from dateutil.relativedelta import relativedelta
 
 import magento
 import logging
+import hashlib
+import json
 import xmlrpclib
 import socket
+import threading
+from multiprocessing.pool import ThreadPool
 
+from sql import Null
+from trytond import backend
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
-from trytond.pyson import Eval
+from trytond.pyson import Eval, If
 from trytond.model import ModelView, ModelSQL, fields
-from .api import OrderConfig
+from .api import OrderConfig, call_concurrently
+from .product import touch
+from .sale import MagentoImportBatch
 
 __metaclass__ = PoolMeta
 __all__ = ['Channel', 'MagentoTier']
@@ -25,8 +33,21 @@ INVISIBLE_IF_NOT_MAGENTO = {
     'invisible': ~(Eval('source') == 'magento'),
 }
 
+
+def positive_if_magento(field_name):
+    "Domain requiring a positive value on the magento channels"
+    return [If(Eval('source') == 'magento', [(field_name, '>', 0)], [])]
+
 logger = logging.getLogger('magento')
 
+#: Maximum number of channels handled at the same time by the crons, each of
+#: them using its own database connection
+CRON_CONCURRENCY = 4
+
+#: Locks of the channels being exported by this process, used on the
+#: backends which have no advisory locks
+_channel_locks = {}
+
 
 def batch(iterable, n=1):
     l = len(iterable)
@@ -34,6 +55,53 @@ def batch(iterable, n=1):
         yield iterable[ndx:min(ndx + n, l)]
 
 
+def run_in_transactions(func, items, concurrency=1):
+    """
+    Call func on each item in its own transaction, from at most
+    `concurrency` worker threads at the same time. The transactions are
+    started with the database, user and context of the current transaction
+    and committed if func succeeds.
+
+    The items are always handled in worker threads, as a transaction cannot
+    be started in a thread which already has one.
+
+    :param func: Function to call on each item
+    :param items: List of items
+    :param concurrency: Maximum number of threads to use
+    :raise: The first exception raised by func, once all the items are
+            handled
+    """
+    if not items:
+        return
+
+    transaction = Transaction()
+    database_name = transaction.cursor.database_name
+    user = transaction.user
+    context = transaction.context.copy()
+
+    def run(item):
+        with Transaction().start(database_name, user, context=context):
+            cursor = Transaction().cursor
+            try:
+                func(item)
+            except Exception, exception:
+                cursor.rollback()
+                logger.exception('Processing of %s failed', item)
+                return exception
+            cursor.commit()
+
+    pool = ThreadPool(max(1, min(concurrency, len(items))))
+    try:
+        exceptions = filter(None, pool.map(run, items))
+    finally:
+        pool.close()
+        pool.join()
+
+    if exceptions:
+        # Raised so that the failure is reported by the cron
+        raise exceptions[0]
+
+
 class Channel:
     """
     Sale Channel model
@@ -90,6 +158,70 @@ class Channel:
         'reference on magento for the exported shipments as well.',
         states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
     )
+
+    #: Checking this will reuse the party created for an earlier guest order
+    #: with the same email instead of creating a new party for every order.
+    magento_reuse_guest_parties = fields.Boolean(
+        'Reuse guest customers', help='Checking this will match guest '
+        'orders to an existing guest customer of this channel by email, '
+        'instead of creating a new party for every guest order.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+
+    #: Checking this will make sure that the inventory of a listing is
+    #: exported only if it changed since the last export.
+    magento_export_changed_inventory_only = fields.Boolean(
+        'Export only changed inventory', help='Checking this will make '
+        'sure that the inventory of a product is exported only if it '
+        'changed since it was last exported to magento.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+
+    #: Checking this will keep the data of the imported orders so that they
+    #: can be imported again without downloading them from magento.
+    magento_archive_orders = fields.Boolean(
+        'Archive imported orders', help='Checking this will keep a '
+        'compressed copy of the data of every order imported from magento, '
+        'which can be used to import the orders again without downloading '
+        'them.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_api_concurrency = fields.Integer(
+        'API Concurrency', help='Maximum number of API sessions used in '
+        'parallel by the bulk exports to magento.',
+        domain=positive_if_magento('magento_api_concurrency'),
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_inventory_batch_size = fields.Integer(
+        'Inventory Batch Size', help='Number of products sent to magento '
+        'in each inventory update call.',
+        domain=positive_if_magento('magento_inventory_batch_size'),
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_tier_price_batch_size = fields.Integer(
+        'Tier Price Batch Size', help='Number of products whose tier '
+        'prices are sent to magento in each API call.',
+        domain=positive_if_magento('magento_tier_price_batch_size'),
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_order_status_batch_size = fields.Integer(
+        'Order Status Batch Size', help='Number of order statuses sent to '
+        'magento in each API call.',
+        domain=positive_if_magento('magento_order_status_batch_size'),
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_tracking_batch_size = fields.Integer(
+        'Tracking Batch Size', help='Number of shipment tracking numbers '
+        'sent to magento in each API call.',
+        domain=positive_if_magento('magento_tracking_batch_size'),
+        states=MAGENTO_STATES, depends=['source']
+    )
+    #: Orders updated on magento after this time are refreshed by the next
+    #: order status update.
+    magento_last_order_status_update_time = fields.DateTime(
+        'Last Order Status Update Time',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
     magento_price_tiers = fields.One2Many(
         'sale.channel.magento.price_tier', 'channel', 'Default Price Tiers',
         states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
@@ -120,7 +252,15 @@ class Channel:
             "multiple_channels": 'Selected operation can be done only for one'
                 ' channel at a time',
             'invalid_magento_channel':
-                'Current channel does not belongs to Magento !'
+                'Current channel does not belongs to Magento !',
+            'tier_price_export_fail':
+                "FaultCode: %s, FaultMessage: %s",
+            'order_status_export_fail':
+                "FaultCode: %s, FaultMessage: %s",
+            'tracking_export_fail':
+                "FaultCode: %s, FaultMessage: %s",
+            'shipment_export_fail':
+                "FaultCode: %s, FaultMessage: %s",
         })
         cls._buttons.update({
             'import_magento_carriers': {
@@ -162,6 +302,34 @@ class Channel:
         """
         return 1
 
+    @staticmethod
+    def default_magento_reuse_guest_parties():
+        return False
+
+    @staticmethod
+    def default_magento_export_changed_inventory_only():
+        return False
+
+    @staticmethod
+    def default_magento_api_concurrency():
+        return 4
+
+    @staticmethod
+    def default_magento_inventory_batch_size():
+        return 50
+
+    @staticmethod
+    def default_magento_tier_price_batch_size():
+        return 50
+
+    @staticmethod
+    def default_magento_order_status_batch_size():
+        return 50
+
+    @staticmethod
+    def default_magento_tracking_batch_size():
+        return 50
+
     def import_order_states(self):
         """
         Import order states for magento channel
@@ -240,24 +408,24 @@ class Channel:
                 ) as order_config_api:
                     carriers_data = order_config_api.get_shipping_methods()
 
+            # The existing carriers of the channel are loaded at once and
+            # only the missing codes are created.
+            codes = set(carrier.code for carrier in SaleChannelCarrier.search([
+                ('channel', '=', channel.id),
+            ]))
             carriers = []
             for data in carriers_data:
-                carrier = SaleChannelCarrier.search([
-                    ('code', '=', data['code']),
-                    ('channel', '=', channel.id),
-                ])
-                if carrier:
+                if data['code'] in codes:
                     continue
-
-                carrier = {
+                codes.add(data['code'])
+                carriers.append({
                     'name': data['label'],
                     'code': data['code'],
                     'channel': channel,
-                }
-                if carrier not in carriers:
-                    carriers.append(carrier)
+                })
 
-            SaleChannelCarrier.create(carriers)
+            if carriers:
+                SaleChannelCarrier.create(carriers)
 
     def import_products(self):
         """
@@ -393,7 +561,6 @@ class Channel:
                 })
                 page = 1
                 has_next = True
-                orders_summaries = []
                 while has_next:
                     # XXX: Pagination is only available in
                     # magento extension >= 1.6.1
@@ -402,29 +569,120 @@ class Channel:
                     )
                     has_next = api_res['hasNext']
                     page += 1
-                    orders_summaries.extend(api_res['items'])
+                    new_sales.extend(self.import_order_page(api_res['items']))
+        return new_sales
+
+    def import_order_page(self, orders_summaries):
+        """
+        Import a page of orders from magento. The contact mechanisms of the
+        customers in these orders are created and their payment transactions
+        are posted together at the end.
 
-                for order_summary in orders_summaries:
-                    new_sales.append(self.import_order(order_summary))
+        :param orders_summaries: List of order summaries from magento
+        :return: List of active record of sale imported
+        """
+        import_batch = MagentoImportBatch()
+        new_sales = [
+            self.import_order(order_summary, import_batch=import_batch)
+            for order_summary in orders_summaries
+        ]
+        self.process_magento_import_batch(import_batch)
         return new_sales
 
-    def import_order(self, order_info):
-        "Downstream implementation to import sale order from magento"
+    def process_magento_import_batch(self, import_batch):
+        """
+        Create the contact mechanisms and post the payment transactions
+        collected while importing a batch of orders from magento.
+
+        :param import_batch: `MagentoImportBatch` of the imported orders
+        """
+        ContactMechanism = Pool().get('party.contact_mechanism')
+
+        ContactMechanism.create_missing_using_magento_data(
+            import_batch.contact_mechanisms
+        )
+        self.post_magento_payment_transactions(
+            import_batch.payment_transactions
+        )
+
+    @staticmethod
+    def post_magento_payment_transactions(payment_transactions):
+        """
+        Post the payment transactions of the orders imported from magento.
+        Like `safe_post`, only the completed transactions are posted, all of
+        them at once.
+
+        :param payment_transactions: List of active records of payment
+                                     transactions
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
+
+        completed = [
+            payment_transaction
+            for payment_transaction in payment_transactions
+            if payment_transaction.state == 'completed'
+        ]
+        if completed:
+            PaymentTransaction.post(completed)
+
+    def import_order(self, order_info, import_batch=None):
+        """
+        Downstream implementation to import sale order from magento
+
+        :param order_info: Order summary from magento
+        :param import_batch: `MagentoImportBatch` collecting the records to
+                             process once the whole batch of orders is
+                             imported
+        """
         if self.source != 'magento':
             return super(Channel, self).import_order(order_info)
 
         Sale = Pool().get('sale.sale')
+        OrderArchive = Pool().get('sale.channel.magento.order_archive')
 
         sale = Sale.find_using_magento_data(order_info)
         if sale:
             return sale
 
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
-                order_data = order_api.info(order_info['increment_id'])
-                return Sale.create_using_magento_data(order_data)
+            order_data = self.get_magento_order_data(
+                order_info['increment_id'], order_info.get('updated_at')
+            )
+            if self.magento_archive_orders:
+                OrderArchive.archive_orders_data(self, [order_data])
+            return Sale.create_using_magento_data(
+                order_data, import_batch=import_batch
+            )
+
+    def reimport_from_archive(self, increment_ids=None):
+        """
+        Import again the orders archived for this channel, without
+        downloading them from magento. The orders which already have a
+        sale are skipped.
+
+        :param increment_ids: List of order increment ids, all the archived
+                              orders if None
+        :return: List of active record of sale imported
+        """
+        Sale = Pool().get('sale.sale')
+        OrderArchive = Pool().get('sale.channel.magento.order_archive')
+
+        self.validate_magento_channel()
+
+        sales = []
+        import_batch = MagentoImportBatch()
+        with Transaction().set_context(current_channel=self.id):
+            for order_data in OrderArchive.iter_orders_data(
+                    self, increment_ids):
+                sale = Sale.find_using_magento_data(order_data)
+                if not sale:
+                    sale = Sale.create_using_magento_data(
+                        order_data, import_batch=import_batch
+                    )
+                sales.append(sale)
+
+            self.process_magento_import_batch(import_batch)
+        return sales
 
     def export_order_status(self):
         """
@@ -439,21 +697,73 @@ class Channel:
         if self.source != 'magento':
             return super(Channel, self).export_order_status()
 
+        cursor = Transaction().cursor
+        sale_table = Sale.__table__()
+
         exported_sales = []
-        domain = [('channel', '=', self.id)]
 
+        # Only the sales of this channel whose state changed since it was
+        # last exported, using the index on (channel, write_date)
+        where = (sale_table.channel == self.id) & (
+            (sale_table.magento_exported_state == Null) |
+            (sale_table.magento_exported_state != sale_table.state)
+        )
         if self.last_order_export_time:
-            domain = [
-                ('write_date', '>=', self.last_order_export_time)
-            ]
+            where &= (sale_table.write_date >= self.last_order_export_time)
 
-        sales = Sale.search(domain)
+        cursor.execute(*sale_table.select(
+            sale_table.id, where=where, order_by=sale_table.id
+        ))
+        sales = Sale.browse([sale_id for sale_id, in cursor.fetchall()])
 
         self.last_order_export_time = datetime.utcnow()
         self.save()
 
+        # Only the cancelled and done orders have something to send, they
+        # are grouped and sent with multiCall over the pooled sessions.
+        sales_to_export = []
+        calls = []
         for sale in sales:
-            exported_sales.append(sale.export_order_status_to_magento())
+            exported_sales.append(sale)
+            call = sale.get_magento_order_status_call()
+            if call is None:
+                continue
+            sales_to_export.append(sale)
+            calls.append(call)
+
+        failed_sales = set()
+        if calls:
+            self.validate_magento_channel()
+            # 103: magento does not accept this order status change due to
+            # its workflow constraints.
+            results = self.call_magento_multi(
+                magento.Order, sales_to_export, calls,
+                self.magento_order_status_batch_size,
+                'order_status_export_fail', ignored_faults=('103',)
+            )
+            for sale, result in zip(sales_to_export, results):
+                if isinstance(result, dict) and result.get('isFault') and \
+                        result['faultCode'] != '103':
+                    # The state was not accepted, keep it as not exported
+                    failed_sales.add(sale)
+
+        # Remember the exported states so that they are not sent again
+        sales_by_state = {}
+        for sale in exported_sales:
+            if sale not in failed_sales:
+                sales_by_state.setdefault(sale.state, []).append(sale)
+        args = []
+        for state, state_sales in sales_by_state.iteritems():
+            args.extend([state_sales, {'magento_exported_state': state}])
+        if args:
+            Sale.write(*args)
+
+        # Keep the failed sales in the delta of the next export, so that
+        # they are sent again
+        touch(
+            Sale, [sale.id for sale in failed_sales],
+            self.last_order_export_time
+        )
 
         return exported_sales
 
@@ -464,8 +774,71 @@ class Channel:
         """
         channels = cls.search([('source', '=', 'magento')])
 
-        for channel in channels:
-            channel.export_shipment_status_to_magento()
+        def export_channel(channel_id):
+            # Each channel is exported in its own transaction so that a slow
+            # or failing store does not hold back the other channels.
+            channel = cls(channel_id)
+            if not channel.lock_magento_channel():
+                logger.info(
+                    'Shipment export of channel %s skipped, '
+                    'it is already running', channel_id
+                )
+                return
+            try:
+                channel.export_shipment_status_to_magento()
+            finally:
+                channel.unlock_magento_channel()
+
+        run_in_transactions(
+            export_channel, [channel.id for channel in channels],
+            CRON_CONCURRENCY
+        )
+
+    def lock_magento_channel(self):
+        """
+        Lock the channel so that two workers do not export it at the same
+        time. On PostgreSQL an advisory lock keyed on the table and the id
+        of the channel is held until the end of the transaction, so that
+        the row of the channel can still be written while a slow store is
+        exported. On the other backends, the channel is locked for this
+        process until `unlock_magento_channel` is called.
+
+        :return: False if the channel is locked by another worker
+        """
+        cursor = Transaction().cursor
+
+        if backend.name() != 'postgresql':
+            lock = _channel_locks.setdefault(
+                (cursor.database_name, self.id), threading.Lock()
+            )
+            return lock.acquire(False)
+
+        cursor.execute(
+            'SELECT pg_try_advisory_xact_lock('
+            'CAST(CAST(%s AS regclass) AS oid)::integer, %s)',
+            ('"' + self._table + '"', self.id)
+        )
+        locked, = cursor.fetchone()
+        return locked
+
+    def unlock_magento_channel(self):
+        """
+        Release the lock taken by `lock_magento_channel` on the backends
+        where it is not released with the transaction
+        """
+        if backend.name() != 'postgresql':
+            _channel_locks[
+                (Transaction().cursor.database_name, self.id)
+            ].release()
+
+    @classmethod
+    def export_inventory_to_magento_using_cron(cls):
+        """
+        Export inventory of the listings whose stock moved using cron
+        """
+        Listing = Pool().get('product.product.channel_listing')
+
+        Listing.export_dirty_magento_inventory()
 
     def export_shipment_status_to_magento(self):
         """
@@ -474,91 +847,231 @@ class Channel:
         :return: List of active record of shipment
         """
         Shipment = Pool().get('stock.shipment.out')
-        Sale = Pool().get('sale.sale')
-        SaleLine = Pool().get('sale.line')
 
         self.validate_magento_channel()
 
-        sale_domain = [
-            ('channel', '=', self.id),
-            ('shipment_state', '=', 'sent'),
-            ('magento_id', '!=', None),
-            ('shipments', '!=', None),
+        # Only the shipments not exported yet are selected, using the index
+        # on magento_increment_id and is_tracking_exported_to_magento, so
+        # the cost does not grow with the history of the channel.
+        shipment_domain = [
+            ('state', '=', 'done'),
+            ('magento_increment_id', '=', None),
+            ('is_tracking_exported_to_magento', '=', False),
+            ('moves.sale.channel', '=', self.id),
+            ('moves.sale.shipment_state', '=', 'sent'),
+            ('moves.sale.magento_id', '!=', None),
         ]
 
         if self.last_shipment_export_time:
-            sale_domain.append(
+            shipment_domain.append(
                 ('write_date', '>=', self.last_shipment_export_time)
             )
 
-        sales = Sale.search(sale_domain)
+        shipments = Shipment.search(shipment_domain)
 
+        last_shipment_export_time = self.last_shipment_export_time
         self.last_shipment_export_time = datetime.utcnow()
         self.save()
 
-        updated_sales = set([])
-        for sale in sales:
-            # Get the increment id from the sale reference
-            increment_id = sale.reference[
-                len(self.magento_order_prefix): len(sale.reference)
-            ]
+        moves_by_shipment, lines = self.get_magento_shipment_moves(shipments)
 
-            for shipment in sale.shipments:
-                try:
-                    # Some checks to make sure that only valid shipments are
-                    # being exported
-                    if shipment.is_tracking_exported_to_magento or \
-                            shipment.state != 'done' or \
-                            shipment.magento_increment_id:
-                        continue
-                    updated_sales.add(sale)
-                    with magento.Shipment(
-                        self.magento_url, self.magento_api_user,
-                        self.magento_api_key
-                    ) as shipment_api:
-                        item_qty_map = {}
-                        for move in shipment.outgoing_moves:
-                            if isinstance(move.origin, SaleLine) \
-                                    and move.origin.magento_id:
-                                # This is done because there can be multiple
-                                # lines with the same product and they need
-                                # to be send as a sum of quanitities
-                                item_qty_map.setdefault(
-                                    str(move.origin.magento_id), 0
-                                )
-                                item_qty_map[str(move.origin.magento_id)] += \
-                                    move.quantity
-                        shipment_increment_id = shipment_api.create(
-                            order_increment_id=increment_id,
-                            items_qty=item_qty_map
-                        )
-                        Shipment.write(list(sale.shipments), {
-                            'magento_increment_id': shipment_increment_id,
-                        })
-
-                        if self.magento_export_tracking_information and (
-                            hasattr(shipment, 'tracking_number') and
-                            hasattr(shipment, 'carrier') and
-                            shipment.tracking_number and shipment.carrier
-                        ):
-                            with Transaction().set_context(
-                                    current_channel=self.id):
-                                shipment.export_tracking_info_to_magento()
-                except xmlrpclib.Fault, fault:
-                    if fault.faultCode == 102:
-                        # A shipment already exists for this order,
-                        # we cannot do anything about it.
-                        # Maybe it was already exported earlier or was created
-                        # separately on magento
-                        # Hence, just continue
-                        continue
+        updated_sales = set([])
+        shipments_to_export = []
+        shipments_data = []
+        for shipment in shipments:
+            sale, shipment_data = self.get_magento_shipment_data(
+                shipment, moves_by_shipment.get(shipment.id, []), lines
+            )
+            if sale is None:
+                continue
+            updated_sales.add(sale)
+            shipments_to_export.append(shipment)
+            shipments_data.append(shipment_data)
+
+        # Read in the current thread, API sessions are used from threads
+        # which have no transaction.
+        url, user, key = (
+            self.magento_url, self.magento_api_user, self.magento_api_key
+        )
+        results = call_concurrently(
+            lambda: magento.Shipment(url, user, key),
+            self.create_magento_shipment, shipments_data,
+            self.magento_api_concurrency
+        )
+
+        # 102: A shipment already exists for this order, maybe it was
+        # exported earlier or created separately on magento. Nothing can be
+        # done about it.
+        faulted = set(self.record_magento_faults(
+            shipments_to_export, results, 'shipment_export_fail',
+            ignored_faults=('102',)
+        ))
+
+        args = []
+        failed_shipment_ids = []
+        for shipment, result in zip(shipments_to_export, results):
+            if shipment not in faulted:
+                args.extend([[shipment], {'magento_increment_id': result}])
+            elif result['faultCode'] != '102':
+                failed_shipment_ids.append(shipment.id)
+        if args:
+            Shipment.write(*args)
+
+        # Keep the failed shipments in the delta of the next export, so that
+        # they are sent again
+        touch(Shipment, failed_shipment_ids, self.last_shipment_export_time)
+
+        if self.magento_export_tracking_information:
+            self.export_shipment_tracking_to_magento(
+                last_shipment_export_time
+            )
 
         return updated_sales
 
+    def export_shipment_tracking_to_magento(self, since=None):
+        """
+        Export the tracking info of the shipments of this channel which are
+        created on magento but whose tracking info is not exported yet.
+
+        The shipments whose export fails are touched, so that they are sent
+        again by the next export only.
+
+        :param since: Only the shipments written since this time are
+                      exported, usually the previous shipment export time
+        :return: List of active records of shipments whose tracking info
+                 was exported
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        # The tracking number and the carrier of the shipment are added by
+        # the shipping modules
+        if 'tracking_number' not in Shipment._fields or \
+                'carrier' not in Shipment._fields:
+            return []
+
+        shipment_domain = [
+            ('state', '=', 'done'),
+            ('magento_increment_id', '!=', None),
+            ('is_tracking_exported_to_magento', '=', False),
+            ('tracking_number', '!=', None),
+            ('carrier', '!=', None),
+            ('moves.sale.channel', '=', self.id),
+        ]
+        if since:
+            shipment_domain.append(('write_date', '>=', since))
+
+        shipments = Shipment.search(shipment_domain)
+        if not shipments:
+            return []
+
+        with Transaction().set_context(current_channel=self.id):
+            exported = Shipment.export_tracking_infos_to_magento(shipments)
+
+        # Keep the failed shipments in the delta of the next export, so that
+        # they are sent again
+        exported_ids = set(shipment.id for shipment in exported)
+        touch(Shipment, [
+            shipment.id for shipment in shipments
+            if shipment.id not in exported_ids
+        ], self.last_shipment_export_time)
+
+        return exported
+
+    @classmethod
+    def get_magento_shipment_moves(cls, shipments):
+        """
+        Fetch the moves of all the shipments and their sale line origins at
+        once instead of walking them shipment by shipment
+
+        :param shipments: List of active record of shipments
+        :return: Tuple of the moves by shipment id and the sale lines by id
+        """
+        Move = Pool().get('stock.move')
+        SaleLine = Pool().get('sale.line')
+
+        moves_by_shipment = {}
+        for move in Move.search([
+            ('shipment', 'in', [str(shipment) for shipment in shipments]),
+        ]):
+            moves_by_shipment.setdefault(move.shipment.id, []).append(move)
+
+        line_ids = set()
+        for moves in moves_by_shipment.itervalues():
+            for move in moves:
+                if isinstance(move.origin, SaleLine):
+                    line_ids.add(move.origin.id)
+        lines = dict(
+            (line.id, line) for line in SaleLine.browse(list(line_ids))
+        )
+        return moves_by_shipment, lines
+
+    def get_magento_shipment_data(self, shipment, moves, lines):
+        """
+        Build the data to create the shipment on magento
+
+        :param shipment: Active record of the shipment
+        :param moves: List of active record of the moves of the shipment
+        :param lines: Dictionary of the sale lines of the moves by id
+        :return: Tuple of the sale and the (increment_id, item_qty_map)
+                 data of the shipment. The sale is None if the shipment has
+                 nothing to export.
+        """
+        SaleLine = Pool().get('sale.line')
+
+        output_location = shipment.warehouse.output_location
+        sale = None
+        item_qty_map = {}
+        for move in moves:
+            # Only the outgoing moves are shipped to the customer
+            if move.from_location != output_location or \
+                    not isinstance(move.origin, SaleLine):
+                continue
+            line = lines[move.origin.id]
+            sale = line.sale
+            if line.magento_id:
+                # This is done because there can be multiple
+                # lines with the same product and they need
+                # to be send as a sum of quanitities
+                item_qty_map.setdefault(str(line.magento_id), 0)
+                item_qty_map[str(line.magento_id)] += move.quantity
+        if sale is None:
+            return None, None
+
+        # Get the increment id from the sale reference
+        increment_id = sale.reference[
+            len(self.magento_order_prefix): len(sale.reference)
+        ]
+
+        return sale, (increment_id, item_qty_map)
+
+    @staticmethod
+    def create_magento_shipment(shipment_api, shipment_data):
+        """
+        Create the shipment on magento. This is called from the API worker
+        threads and must not access the database.
+
+        :param shipment_api: Magento shipment API session
+        :param shipment_data: Tuple of (increment_id, item_qty_map)
+        :return: The magento increment id of the shipment, or the fault as
+                 a dictionary like the ones returned by multiCall
+        """
+        increment_id, item_qty_map = shipment_data
+        try:
+            return shipment_api.create(
+                order_increment_id=increment_id,
+                items_qty=item_qty_map
+            )
+        except xmlrpclib.Fault, fault:
+            return {
+                'isFault': True,
+                'faultCode': str(fault.faultCode),
+                'faultMessage': fault.faultString,
+            }
+
     def export_product_prices(self):
         """
         Exports tier prices of products from tryton to magento for this channel
-        :return: List of products
+        :return: Number of product listings exported
         """
         if self.source != 'magento':
             return super(Channel, self).export_product_prices()
@@ -570,59 +1083,282 @@ class Channel:
         ]
 
         if self.last_product_price_export_time:
-            price_domain.append([
-                'OR', [(
-                    'product.write_date', '>=',
-                    self.last_product_price_export_time
-                )], [(
-                    'product.template.write_date', '>=',
-                    self.last_product_price_export_time
-                )]
-            ])
+            price_domain.append(self.get_magento_price_changes_domain(
+                self.last_product_price_export_time
+            ))
 
         product_listings = ChannelListing.search(price_domain)
 
         self.last_product_price_export_time = datetime.utcnow()
         self.save()
 
+        tier_prices = self.get_magento_tier_prices(product_listings)
+
+        listings_to_export = []
+        calls = []
+        digests = []
         for listing in product_listings:
+            price_data = [{
+                'qty': quantity,
+                'price': float(price),
+            } for quantity, price in tier_prices[listing.id]]
+
+            # Do not send the same tier prices again
+            digest = hashlib.sha1(
+                json.dumps(price_data, sort_keys=True)
+            ).hexdigest()
+            if digest == listing.magento_tier_price_digest:
+                continue
+
+            listings_to_export.append(listing)
+            digests.append(digest)
+            calls.append([
+                'catalog_product_attribute_tier_price.update',
+                [listing.product_identifier, price_data, 'productID'],
+            ])
+        results = self.call_magento_multi(
+            magento.ProductTierPrice, listings_to_export, calls,
+            self.magento_tier_price_batch_size, 'tier_price_export_fail'
+        )
+
+        # Remember what was exported to the listings
+        args = []
+        for listing, digest, result in zip(
+                listings_to_export, digests, results):
+            if isinstance(result, dict) and result.get('isFault'):
+                continue
+            args.extend([[listing], {'magento_tier_price_digest': digest}])
+        if args:
+            ChannelListing.write(*args)
+
+        return len(listings_to_export)
+
+    def get_magento_price_changes_domain(self, since):
+        """
+        Returns the domain of the listings of this channel whose tier prices
+        could have changed since the given time. Besides changes on the
+        product, this looks for changes on the tiers of the listing, on the
+        default tiers of the channel and on the rules of the price list.
 
-            # Get the price tiers from the product listing if the list has
-            # price tiers else get the default price tiers from current
-            # channel
-            price_tiers = listing.price_tiers or self.magento_price_tiers
-
-            price_data = []
-            for tier in price_tiers:
-                if hasattr(tier, 'product_listing'):
-                    # The price tier comes from a product listing, then it has a
-                    # function field for price, we use it directly
-                    price = tier.price
-                else:
-                    # The price tier comes from the default tiers on
-                    # channel,
-                    # we dont have a product on tier, so we use the current
-                    # product in loop for computing the price for this tier
-                    price = self.price_list.compute(
-                        None, listing.product, listing.product.list_price,
-                        tier.quantity, self.default_uom
-                    )
+        :param since: Datetime of the last export of the prices
+        :return: Domain on product.product.channel_listing
+        """
+        PriceList = Pool().get('product.price_list')
+        PriceListLine = Pool().get('product.price_list.line')
+        MagentoTier = Pool().get('sale.channel.magento.price_tier')
+
+        changed_domain = [
+            'OR',
+            ('create_date', '>=', since),
+            ('write_date', '>=', since),
+        ]
 
-                price_data.append({
-                    'qty': tier.quantity,
-                    'price': float(price),
-                })
+        price_list = self.price_list
+        if PriceList.search([
+            ('id', '=', price_list.id),
+            changed_domain,
+        ], count=True):
+            # Price list itself changed, any price could have changed
+            return []
+        if MagentoTier.search([
+            ('channel', '=', self.id),
+            changed_domain,
+        ], count=True):
+            # Default tiers changed, export all
+            return []
+
+        domain = [
+            'OR', [(
+                'product.write_date', '>=', since
+            )], [(
+                'product.template.write_date', '>=', since
+            )], [(
+                'price_tiers.create_date', '>=', since
+            )], [(
+                'price_tiers.write_date', '>=', since
+            )],
+        ]
 
-            # Update stock information to magento
-            with magento.ProductTierPrice(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as tier_price_api:
-                tier_price_api.update(
-                    listing.product_identifier, price_data,
-                    identifierType="productID"
-                )
+        products = set()
+        categories = set()
+        for line in PriceListLine.search([
+            ('price_list', '=', price_list.id),
+            changed_domain,
+        ]):
+            if line.product:
+                products.add(line.product.id)
+            elif getattr(line, 'category', None):
+                categories.add(line.category.id)
+            else:
+                # Rule applies to all the products
+                return []
+        if products:
+            domain.append([('product', 'in', list(products))])
+        if categories:
+            domain.append([
+                ('product.template.category', 'child_of', list(categories))
+            ])
+        return domain
+
+    def get_magento_carrier_mappings(self):
+        """
+        Return the magento code and title of the carriers mapped on this
+        channel.
+
+        :return: Dictionary mapping carrier ID to (`code`, `title`)
+        """
+        SaleChannelCarrier = Pool().get('sale.channel.carrier')
+
+        channel_carriers = {}
+        for channel_carrier in SaleChannelCarrier.search([
+            ('channel', '=', self.id),
+            ('carrier', '!=', None),
+        ]):
+            channel_carriers.setdefault(
+                channel_carrier.carrier.id, []
+            ).append(channel_carrier)
+
+        mappings = {}
+        for carrier_id, carriers in channel_carriers.iteritems():
+            # A carrier mapped more than once is ambiguous, it is sent as
+            # custom like a carrier which is not mapped
+            if len(carriers) == 1:
+                mappings[carrier_id] = carriers[0].get_magento_mapping()
+        return mappings
+
+    def call_magento_multi(
+        self, api_class, records, calls, batch_size, error, ignored_faults=()
+    ):
+        """
+        Send the API calls to magento grouped with multiCall, the batches
+        being sent concurrently over the API sessions of this channel.
+        A fault for a call is recorded as a channel exception on the
+        corresponding record instead of stopping the other calls.
+
+        :param api_class: Magento API class to open the sessions with
+        :param records: List of active records, one per call
+        :param calls: List of [resource path, arguments] to call
+        :param batch_size: Number of calls grouped in a multiCall
+        :param error: Error message used to log the faults
+        :param ignored_faults: Fault codes which are not recorded
+        :return: List of results, one per call
+        """
+        # The channel cannot be read from the threads calling the API
+        url, api_user, api_key = (
+            self.magento_url, self.magento_api_user, self.magento_api_key
+        )
+
+        def multi_call(api, calls_batch):
+            try:
+                return api.multiCall(calls_batch)
+            except xmlrpclib.Fault, fault:
+                # Do not lose the other batches, report the fault for
+                # every call of this batch instead.
+                return [{
+                    'isFault': True,
+                    'faultCode': str(fault.faultCode),
+                    'faultMessage': fault.faultString,
+                }] * len(calls_batch)
+
+        results = []
+        for response in call_concurrently(
+                lambda: api_class(url, api_user, api_key),
+                multi_call, list(batch(calls, batch_size)),
+                self.magento_api_concurrency):
+            results.extend(response)
+
+        self.record_magento_faults(records, results, error, ignored_faults)
+
+        return results
+
+    def record_magento_faults(
+        self, records, results, error, ignored_faults=()
+    ):
+        """
+        Record the faults returned by magento as channel exceptions on the
+        corresponding records. A fault already recorded on a record is not
+        recorded again, so the records retried by the next exports do not
+        get a new exception on every run.
+
+        :param records: List of active records, one per result
+        :param results: List of results of the API calls, the faults being
+                        dictionaries like the ones returned by multiCall
+        :param error: Error message used to log the faults
+        :param ignored_faults: Fault codes which are not recorded
+        :return: List of active records whose call faulted, including the
+                 ignored faults
+        """
+        ChannelException = Pool().get('channel.exception')
+
+        faulted = []
+        exceptions = {}
+        for record, result in zip(records, results):
+            if not (isinstance(result, dict) and result.get('isFault')):
+                continue
+            faulted.append(record)
+            if result['faultCode'] in ignored_faults:
+                continue
+            origin = '%s,%s' % (record.__name__, record.id)
+            log = self.raise_user_error(
+                error, (result['faultCode'], result['faultMessage']),
+                raise_exception=False
+            )
+            exceptions[(origin, log)] = {
+                'origin': origin,
+                'log': log,
+                'channel': self.id,
+            }
+
+        if exceptions:
+            for exception in ChannelException.search([
+                ('channel', '=', self.id),
+                ('origin', 'in', list(set(
+                    origin for origin, _ in exceptions
+                ))),
+            ]):
+                exceptions.pop((str(exception.origin), exception.log), None)
+        if exceptions:
+            ChannelException.create(exceptions.values())
+
+        return faulted
+
+    def get_magento_tier_prices(self, listings):
+        """
+        Compute the tier prices of all the listings in one pass. The price
+        list of the channel is loaded once and each (product, quantity) pair
+        is computed only once.
 
-        return len(product_listings)
+        :param listings: List of active records of listings of this channel
+        :return: Dictionary mapping listing id to list of (quantity, price)
+        """
+        price_list = self.price_list
+        uom = self.default_uom
+        default_quantities = [
+            tier.quantity for tier in self.magento_price_tiers
+        ]
+
+        prices = {}
+        tier_prices = {}
+        for listing in listings:
+            product = listing.product
+
+            # Get the price tiers from the product listing if the list has
+            # price tiers else get the default price tiers from channel
+            quantities = [
+                tier.quantity for tier in listing.price_tiers
+            ] or default_quantities
+
+            for quantity in quantities:
+                key = (product.id, quantity)
+                if key not in prices:
+                    prices[key] = price_list.compute(
+                        None, product, product.list_price, quantity, uom
+                    )
+            tier_prices[listing.id] = [
+                (quantity, prices[(product.id, quantity)])
+                for quantity in quantities
+            ]
+        return tier_prices
 
     def get_default_tryton_action(self, code, name):
         """
@@ -670,6 +1406,7 @@ class Channel:
     def update_order_status(self):
         "Downstream implementation of order_status update"
         Sale = Pool().get('sale.sale')
+        OrderCache = Pool().get('sale.channel.magento.order_cache')
 
         if self.source != 'magento':
             return super(Channel, self).update_order_status()
@@ -678,29 +1415,133 @@ class Channel:
             ('channel', '=', self.id),
             ('state', 'in', ('confirmed', 'processing')),
         ])
-        order_ids = [sale.reference for sale in sales]
+        # Get the increment ids from the sale references, the sales are
+        # then matched by increment id without searching them again.
+        prefix = self.magento_order_prefix or ''
+        order_ids = [sale.reference[len(prefix):] for sale in sales]
+        sales_by_increment_id = dict(zip(order_ids, sales))
+
+        update_time = datetime.utcnow()
+        updated_at = {}
+        if self.magento_last_order_status_update_time and order_ids:
+            # Refresh only the orders which changed on magento since the
+            # last update instead of all the open orders
+            updated_at = self.get_magento_updated_orders(
+                self.magento_last_order_status_update_time
+            )
+            order_ids = filter(
+                lambda order_id: order_id in updated_at, order_ids
+            )
+
         for order_ids_batch in batch(order_ids, 50):
+            # The order data is taken from the cache when the same version
+            # of the order was fetched recently by the order import or a
+            # lookup by increment id. The orders fetched here are not
+            # cached, as only the import and the lookups of orders without
+            # a sale would read them.
+            orders_data = OrderCache.get_orders_data(self, [
+                (order_id, updated_at[order_id])
+                for order_id in order_ids_batch if order_id in updated_at
+            ])
+            order_ids_to_fetch = [
+                order_id for order_id in order_ids_batch
+                if order_id not in orders_data
+            ]
+
+            if order_ids_to_fetch:
+                with magento.Order(
+                    self.magento_url, self.magento_api_user,
+                    self.magento_api_key
+                ) as order_api:
+                    fetched_orders_data = order_api.info_multi(
+                        order_ids_to_fetch
+                    )
+
+                for order_id, order_data in zip(
+                        order_ids_to_fetch, fetched_orders_data):
+                    if order_data.get('isFault'):
+                        if order_data['faultCode'] == '100':
+                            # 100: Requested order not exists.
+                            # TODO: Remove order from channel or add some
+                            # exception.
+                            pass
+                        logger.warning("Order %s: %s %s" % (
+                            order_id, order_data['faultCode'],
+                            order_data['faultMessage']
+                        ))
+                        continue
+                    orders_data[order_id] = order_data
+
+            order_ids_found = [
+                order_id for order_id in order_ids_batch
+                if order_id in orders_data
+            ]
+            Sale.update_order_status_using_magento_data(
+                [sales_by_increment_id[order_id]
+                    for order_id in order_ids_found],
+                [orders_data[order_id] for order_id in order_ids_found]
+            )
+
+        self.write([self], {
+            'magento_last_order_status_update_time': update_time,
+        })
+
+    def get_magento_updated_orders(self, updated_at_min):
+        """
+        Return the orders of this channel updated on magento since the
+        given time.
+
+        :param updated_at_min: Datetime in UTC
+        :return: Dictionary mapping order increment id to its updated_at
+        """
+        filter = {
+            'store_id': {'=': self.magento_store_id},
+            'updated_at': {'gteq': updated_at_min.isoformat(' ')},
+        }
+        updated_at = {}
+        with magento.Order(
+            self.magento_url, self.magento_api_user, self.magento_api_key
+        ) as order_api:
+            page = 1
+            has_next = True
+            while has_next:
+                # XXX: Pagination is only available in
+                # magento extension >= 1.6.1
+                api_res = order_api.search(
+                    filters=filter, limit=3000, page=page
+                )
+                has_next = api_res['hasNext']
+                page += 1
+                for order in api_res['items']:
+                    updated_at[order['increment_id']] = order['updated_at']
+        return updated_at
+
+    def get_magento_order_data(self, increment_id, updated_at=None):
+        """
+        Return the order data of the order from magento, using the order
+        data cached recently for the same version of the order if there is
+        one.
+
+        :param increment_id: Order increment ID from magento
+        :param updated_at: Last update time of the order on magento, the
+                           order is always fetched if None as the cached
+                           order data could be outdated
+        :return: Order data from magento
+        """
+        OrderCache = Pool().get('sale.channel.magento.order_cache')
+
+        order_data = None
+        if updated_at is not None:
+            order_data = OrderCache.get_orders_data(
+                self, [(increment_id, updated_at)]
+            ).get(increment_id)
+        if order_data is None:
             with magento.Order(
                 self.magento_url, self.magento_api_user, self.magento_api_key
             ) as order_api:
-                orders_data = order_api.info_multi(order_ids_batch)
-
-            for i, order_data in enumerate(orders_data):
-                if order_data.get('isFault'):
-                    if order_data['faultCode'] == '100':
-                        # 100: Requested order not exists.
-                        # TODO: Remove order from channel or add some
-                        # exception.
-                        pass
-                    logger.warning("Order %s: %s %s" % (
-                        order_ids_batch[i], order_data['faultCode'],
-                        order_data['faultMessage']
-                    ))
-                    continue
-                sale, = Sale.search([
-                    ('reference', '=', order_data['increment_id'])
-                ])
-                sale.update_order_status_from_magento(order_data=order_data)
+                order_data = order_api.info(increment_id)
+            OrderCache.set_orders_data(self, [order_data])
+        return order_data
 
 
 class MagentoTier(ModelSQL, ModelView):
@@ -731,3 +1572,16 @@ class MagentoTier(ModelSQL, ModelView):
                 'Quantity in price tiers must be unique for a channel'
             )
         ]
+
+    @classmethod
+    def delete(cls, tiers):
+        PriceList = Pool().get('product.price_list')
+
+        price_list_ids = set(
+            tier.channel.price_list.id for tier in tiers
+            if tier.channel.price_list
+        )
+        super(MagentoTier, cls).delete(tiers)
+        # The default tiers apply to all the listings of the channels,
+        # touching their price lists makes the next export check them all.
+        touch(PriceList, price_list_ids)
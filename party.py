@@ -1,15 +1,24 @@
 # -*- coding: utf-8 -*-
 import magento
 
+from trytond import backend
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 
 
-__all__ = ['Party', 'MagentoWebsiteParty', 'Address']
+__all__ = ['Party', 'MagentoWebsiteParty', 'Address', 'ContactMechanism']
 __metaclass__ = PoolMeta
 
 
+def normalize_email(email):
+    """
+    Normalize the email so that the same address sent with different
+    case or surrounding spaces can be matched.
+    """
+    return email and email.strip().lower() or None
+
+
 class Party:
     "Party"
     __name__ = 'party.party'
@@ -146,6 +155,39 @@ class Party:
         else:
             return magento_party.party
 
+    @classmethod
+    def find_guest_using_magento_data(cls, magento_data):
+        """
+        Looks for a guest customer of the magento_channel in context who
+        already ordered with the email in magento_data.
+        If record exists returns that else None
+
+        :param magento_data: Dictionary of values for customer sent by magento
+        :return: Active record of record found or None
+        """
+        ContactMechanism = Pool().get('party.contact_mechanism')
+
+        email = normalize_email(magento_data.get('email'))
+        if not email:
+            return None
+
+        channel_id = Transaction().context['current_channel']
+
+        # The lookup is done on the (type, value) index of contact
+        # mechanisms, there are only a handful of matches per email.
+        contact_mechanisms = ContactMechanism.search([
+            ('type', '=', 'email'),
+            ('value', '=', email),
+        ], order=[('id', 'ASC')])
+        for contact_mechanism in contact_mechanisms:
+            party = contact_mechanism.party
+            for magento_party in party.magento_ids:
+                # magento_id of 0 means its a guest customer.
+                if magento_party.channel.id == channel_id and \
+                        magento_party.magento_id == 0:
+                    return party
+        return None
+
 
 class MagentoWebsiteParty(ModelSQL, ModelView):
     "Magento Website Party"
@@ -252,13 +294,17 @@ class Address:
             return magento_street_address, None
 
     @classmethod
-    def find_or_create_for_party_using_magento_data(cls, party, address_data):
+    def find_or_create_for_party_using_magento_data(
+            cls, party, address_data, import_batch=None):
         """
         Look for the address in tryton corresponding to the address_record.
         If found, return the same else create a new one and return that.
 
         :param party: Party active record
         :param address_data: Dictionary of address data from magento
+        :param import_batch: `MagentoImportBatch` collecting the contact
+                             mechanisms to create once the whole batch of
+                             orders is imported
         :return: Active record of address created/found
         """
         for address in party.addresses:
@@ -267,19 +313,24 @@ class Address:
 
         else:
             address = cls.create_for_party_using_magento_data(
-                party, address_data
+                party, address_data, import_batch=import_batch
             )
 
         return address
 
     @classmethod
-    def create_for_party_using_magento_data(cls, party, address_data):
+    def create_for_party_using_magento_data(
+            cls, party, address_data, import_batch=None):
         """
         Create address from the address record given and link it to the
         party.
 
         :param party: Party active record
         :param address_data: Dictionary of address data from magento
+        :param import_batch: `MagentoImportBatch` collecting the contact
+                             mechanisms to create once the whole batch of
+                             orders is imported, they are created right
+                             away if None
         :return: Active record of created address
         """
         Country = Pool().get('country.country')
@@ -312,15 +363,80 @@ class Address:
         }])
 
         # Create phone as contact mechanism
-        if address_data.get('telephone') and not ContactMechanism.search([
-            ('party', '=', party.id),
-            ('type', 'in', ['phone', 'mobile']),
-            ('value', '=', address_data['telephone']),
-        ]):
-            ContactMechanism.create([{
+        if address_data.get('telephone'):
+            contact_mechanism = {
                 'party': party.id,
                 'type': 'phone',
                 'value': address_data['telephone'],
-            }])
+            }
+            if import_batch is not None:
+                import_batch.contact_mechanisms.append(contact_mechanism)
+            else:
+                ContactMechanism.create_missing_using_magento_data(
+                    [contact_mechanism]
+                )
 
         return address
+
+
+class ContactMechanism:
+    "Contact Mechanism"
+    __name__ = 'party.contact_mechanism'
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(ContactMechanism, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+
+        # Guest customers are looked up by their email
+        table.index_action(['type', 'value'], 'add')
+        # Existence check before creating contact mechanisms from magento
+        table.index_action(['party', 'type', 'value'], 'add')
+
+    @staticmethod
+    def _magento_key(party_id, type_, value):
+        """
+        Key identifying a contact mechanism of a party. A phone and a mobile
+        with the same number are the same for magento.
+        """
+        if type_ in ('phone', 'mobile'):
+            type_ = 'phone'
+        return party_id, type_, value
+
+    @classmethod
+    def create_missing_using_magento_data(cls, vlist):
+        """
+        Create the contact mechanisms from vlist in one batch, skipping the
+        duplicates in vlist and the ones the party already has.
+
+        :param vlist: List of dictionaries with party, type and value
+        :return: List of active records of contact mechanisms created
+        """
+        if not vlist:
+            return []
+
+        existing = set(
+            cls._magento_key(record.party.id, record.type, record.value)
+            for record in cls.search([
+                ('party', 'in', list(set(v['party'] for v in vlist))),
+                ('value', 'in', list(set(v['value'] for v in vlist))),
+            ])
+        )
+
+        to_create = []
+        for values in vlist:
+            key = cls._magento_key(
+                values['party'], values['type'], values['value']
+            )
+            if key in existing:
+                continue
+            existing.add(key)
+            to_create.append(values)
+
+        if not to_create:
+            return []
+        return cls.create(to_create)
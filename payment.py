@@ -2,6 +2,7 @@
 from trytond.pool import PoolMeta
 from trytond.model import fields, ModelSQL, ModelView
 from trytond.transaction import Transaction
+from trytond.cache import Cache
 
 __metaclass__ = PoolMeta
 __all__ = ['MagentoPaymentGateway', 'Payment']
@@ -25,6 +26,11 @@ class MagentoPaymentGateway(ModelSQL, ModelView):
         domain=[('source', '=', 'magento')]
     )
 
+    #: Maps the channel id to the gateway ids by payment method name
+    _magento_gateways_cache = Cache(
+        'magento.instance.payment_gateway.magento_gateways', context=False
+    )
+
     @classmethod
     def __setup__(cls):
         """
@@ -38,27 +44,89 @@ class MagentoPaymentGateway(ModelSQL, ModelView):
             )
         ]
 
+    @classmethod
+    def create(cls, vlist):
+        records = super(MagentoPaymentGateway, cls).create(vlist)
+        cls._magento_gateways_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(MagentoPaymentGateway, cls).write(*args)
+        cls._magento_gateways_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super(MagentoPaymentGateway, cls).delete(records)
+        cls._magento_gateways_cache.clear()
+
+    @classmethod
+    def get_magento_gateways(cls, channel_id):
+        """
+        Return the gateways of the channel by payment method name. They are
+        loaded once and cached until a gateway is changed.
+
+        :param channel_id: ID of the channel
+        :return: Dictionary mapping payment method name to gateway ID
+        """
+        gateways = cls._magento_gateways_cache.get(channel_id)
+        if gateways is None:
+            gateways = dict(
+                (gateway.name, gateway.id)
+                for gateway in cls.search([('channel', '=', channel_id)])
+            )
+            cls._magento_gateways_cache.set(channel_id, gateways)
+        return gateways
+
     @classmethod
     def create_all_using_magento_data(cls, magento_data):
         """
         Creates record for list of payment gateways sent by magento.
         It creates a new gateway only if one with the same name does not
         exist for this channel.
+
+        The missing gateways are created at once using the values of
+        `get_values_using_magento_data`. If it is not implemented, they are
+        created one by one with `create_using_magento_data`.
         """
-        gateways = []
+        gateways = dict(cls.get_magento_gateways(
+            Transaction().context['current_channel']
+        ))
+
+        vlist = []
         for data in magento_data:
-            gateway = cls.find_using_magento_data(data)
-            if gateway:
-                gateways.append(gateway)
-            else:
-                gateways.append(cls.create_using_magento_data(data))
-        return gateways
+            if data['name'] in gateways:
+                continue
+            try:
+                values = cls.get_values_using_magento_data(data)
+            except NotImplementedError:
+                gateway = cls.create_using_magento_data(data)
+                gateways[data['name']] = gateway.id
+                continue
+            # Reserve the name so that duplicates are created only once
+            gateways[data['name']] = None
+            vlist.append(values)
+        if vlist:
+            # All the missing gateways are created at once
+            gateways.update(
+                (gateway.name, gateway.id) for gateway in cls.create(vlist)
+            )
+
+        return cls.browse([gateways[data['name']] for data in magento_data])
 
     @classmethod
     def create_using_magento_data(cls, gateway_data):
         """
         Create record for gateway data sent by magento
         """
+        gateway, = cls.create([cls.get_values_using_magento_data(gateway_data)])
+        return gateway
+
+    @classmethod
+    def get_values_using_magento_data(cls, gateway_data):
+        """
+        Return the values to create a record for gateway data sent by magento
+        """
         raise NotImplementedError
 
     @classmethod
@@ -67,15 +135,12 @@ class MagentoPaymentGateway(ModelSQL, ModelView):
         Search for an existing gateway by matching name and channel.
         If found, return its active record else None
         """
-        try:
-            gateway, = cls.search([
-                ('name', '=', gateway_data['name']),
-                ('channel', '=', Transaction().context['current_channel']),
-            ])
-        except ValueError:
+        gateway_id = cls.get_magento_gateways(
+            Transaction().context['current_channel']
+        ).get(gateway_data['name'])
+        if gateway_id is None:
             return None
-        else:
-            return gateway
+        return cls(gateway_id)
 
 
 class Payment:
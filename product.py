@@ -1,19 +1,23 @@
 # -*- coding: UTF-8 -*-
 import magento
+import xmlrpclib
 from collections import defaultdict
 
 import logbook
+from sql.functions import CurrentTimestamp
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.transaction import Transaction
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval
 from decimal import Decimal
 
+from .api import call_concurrently, map_concurrently
+
 
 __all__ = [
     'Category', 'MagentoInstanceCategory', 'Product',
     'ProductSaleChannelListing',
-    'ProductPriceTier',
+    'ProductPriceTier', 'PriceListLine',
 ]
 __metaclass__ = PoolMeta
 
@@ -26,6 +30,26 @@ def batch(iterable, n=1):
         yield iterable[ndx:min(ndx + n, l)]
 
 
+def touch(model, ids, write_date=None):
+    """
+    Set the write date of the records without changing them, so that the
+    exports using the write date find them again. For example, the tier
+    price export finds the products whose prices changed when records they
+    depend on are deleted.
+
+    :param model: Model class of the records
+    :param ids: List of record ids
+    :param write_date: Write date to set, now if None
+    """
+    if not ids:
+        return
+    table = model.__table__()
+    Transaction().cursor.execute(*table.update(
+        [table.write_date], [write_date or CurrentTimestamp()],
+        where=table.id.in_(list(ids))
+    ))
+
+
 class Category:
     "Product Category"
     __name__ = "product.category"
@@ -214,6 +238,34 @@ class ProductSaleChannelListing:
             "invisible": Eval('channel_source') != 'magento'
         }, depends=['channel_source']
     )
+    magento_exported_quantity = fields.Float(
+        'Exported Quantity', readonly=True, states={
+            "invisible": Eval('channel_source') != 'magento'
+        }, depends=['channel_source']
+    )
+    magento_exported_in_stock = fields.Boolean(
+        'Exported In Stock', readonly=True, states={
+            "invisible": Eval('channel_source') != 'magento'
+        }, depends=['channel_source']
+    )
+
+    #: Digest of the tier prices last exported to magento
+    magento_tier_price_digest = fields.Char(
+        'Tier Price Digest', readonly=True, states={
+            "invisible": Eval('channel_source') != 'magento'
+        }, depends=['channel_source']
+    )
+    #: Set when the stock of the product moved since the inventory was
+    #: last exported to magento
+    magento_inventory_dirty = fields.Boolean(
+        'Inventory To Export', readonly=True, select=True, states={
+            "invisible": Eval('channel_source') != 'magento'
+        }, depends=['channel_source']
+    )
+
+    @staticmethod
+    def default_magento_inventory_dirty():
+        return False
 
     @classmethod
     def __setup__(cls):
@@ -223,6 +275,20 @@ class ProductSaleChannelListing:
             "FaultCode: %s, FaultMessage: %s",
         })
 
+    @classmethod
+    def copy(cls, listings, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        # Nothing was exported for the copies yet
+        default['magento_exported_quantity'] = None
+        default['magento_exported_in_stock'] = None
+        default['magento_tier_price_digest'] = None
+        default['magento_inventory_dirty'] = True
+        return super(ProductSaleChannelListing, cls).copy(
+            listings, default=default
+        )
+
     @classmethod
     def create_from(cls, channel, product_data):
         """
@@ -269,8 +335,6 @@ class ProductSaleChannelListing:
 
         Do not rely on the return value from this method.
         """
-        SaleChannelListing = Pool().get('product.product.channel_listing')
-
         if not listings:
             # Nothing to update
             return
@@ -292,56 +356,251 @@ class ProductSaleChannelListing:
             % len(magento_listings)
         )
 
+        inventory_channel_map = cls.get_magento_inventory_data(
+            magento_listings
+        )
+        responses = cls.push_magento_inventory(inventory_channel_map)
+        cls.save_magento_inventory_responses(responses)
+
+    @classmethod
+    def get_magento_inventory_data(cls, listings):
+        """
+        Build the inventory data to be sent to magento for the listings.
+        Listings whose inventory did not change are left out when the
+        channel exports only changed inventory.
+
+        :param listings: List of active records of magento listings
+        :return: Dictionary mapping channel to list of
+                 (`listing`, `product_data`)
+        """
+        quantities = cls.get_magento_inventory_quantities(listings)
+
         inventory_channel_map = defaultdict(list)
-        for listing in magento_listings:
+        for listing in listings:
             channel = listing.channel
+            quantity = quantities[listing.id]
 
             product_data = {
-                'qty': listing.quantity,
+                'qty': quantity,
             }
 
             # TODO: Get this from availability used
             if listing.magento_product_type == 'simple':
                 # Only send inventory for simple products
                 product_data['is_in_stock'] = '1' \
-                    if listing.quantity > 0 else '0'
+                    if quantity > 0 else '0'
             else:
                 # configurable, bundle and everything else
                 product_data['is_in_stock'] = '1'
 
+            if channel.magento_export_changed_inventory_only and \
+                    not listing.is_magento_inventory_changed(product_data):
+                continue
+
             # group inventory xml by channel
-            inventory_channel_map[channel].append([
-                listing.product_identifier, product_data
-            ])
+            inventory_channel_map[channel].append((listing, product_data))
+        return inventory_channel_map
 
-        for channel, product_data_list in inventory_channel_map.iteritems():
-            with magento.Inventory(
-                    channel.magento_url,
-                    channel.magento_api_user,
-                    channel.magento_api_key) as inventory_api:
-                for product_data_batch in batch(product_data_list, 50):
-                    log.info(
-                        "Pushing inventory of %d products to magento"
-                        % len(product_data_batch)
-                    )
-                    response = inventory_api.update_multi(product_data_batch)
-                    # Magento bulk API will not raise Faults.
-                    # Instead the response contains the faults as a dict
-                    for i, result in enumerate(response):
-                        if result is not True:
-                            if result.get('isFault') is True and \
-                                    result['faultCode'] == '101':
-                                listing, = SaleChannelListing.search([
-                                    ('product_identifier', '=', product_data_batch[i][0]),  # noqa
-                                    ('channel', '=', channel.id),
-                                ])
-                                listing.state = 'disabled'
-                                listing.save()
-                            else:
-                                cls.raise_user_error(
-                                    'multi_inventory_update_fail',
-                                    (result['faultCode'], result['faultMessage'])  # noqa
-                                )
+    @classmethod
+    def push_magento_inventory(cls, inventory_channel_map):
+        """
+        Push the inventory data to magento, in batches sent concurrently
+        for every channel.
+
+        :param inventory_channel_map: Dictionary mapping channel to list of
+                                      (`listing`, `product_data`)
+        :return: Dictionary mapping channel to list of
+                 (`listing_batch`, `response`)
+        """
+        def push_channel_inventory(job):
+            (url, api_user, api_key, concurrency), product_data_batches = job
+
+            def push_inventory(inventory_api, product_data_batch):
+                log.info(
+                    "Pushing inventory of %d products to magento"
+                    % len(product_data_batch)
+                )
+                try:
+                    return inventory_api.update_multi(product_data_batch)
+                except xmlrpclib.Fault, fault:
+                    # Do not lose the other batches, report the fault
+                    # for every product of this batch instead.
+                    return [{
+                        'isFault': True,
+                        'faultCode': str(fault.faultCode),
+                        'faultMessage': fault.faultString,
+                    }] * len(product_data_batch)
+
+            return call_concurrently(
+                lambda: magento.Inventory(url, api_user, api_key),
+                push_inventory, product_data_batches, concurrency
+            )
+
+        # The records cannot be read from the threads pushing the
+        # inventory, so everything they need is read beforehand.
+        channels = inventory_channel_map.keys()
+        listing_batches = {}
+        jobs = []
+        for channel in channels:
+            listing_batches[channel] = list(batch(
+                inventory_channel_map[channel],
+                channel.magento_inventory_batch_size
+            ))
+            jobs.append((
+                (
+                    channel.magento_url, channel.magento_api_user,
+                    channel.magento_api_key, channel.magento_api_concurrency,
+                ),
+                [
+                    [
+                        [listing.product_identifier, listing_data]
+                        for listing, listing_data in listing_batch
+                    ] for listing_batch in listing_batches[channel]
+                ],
+            ))
+        responses = map_concurrently(
+            push_channel_inventory, jobs, len(jobs)
+        )
+
+        return dict(
+            (channel, zip(listing_batches[channel], channel_responses))
+            for channel, channel_responses in zip(channels, responses)
+        )
+
+    @classmethod
+    def save_magento_inventory_responses(cls, responses):
+        """
+        Record the result of the inventory export: the exported inventory
+        is remembered, the listings of products missing on magento are
+        disabled and the other faults are logged as channel exceptions.
+
+        :param responses: Dictionary mapping channel to list of
+                          (`listing_batch`, `response`)
+        """
+        ChannelException = Pool().get('channel.exception')
+
+        exported_listings = defaultdict(list)
+        disabled_listings = []
+        exceptions = []
+        for channel, channel_responses in responses.iteritems():
+            for listing_batch, response in channel_responses:
+                # Magento bulk API will not raise Faults.
+                # Instead the response contains the faults as a dict
+                for (listing, product_data), result in zip(
+                        listing_batch, response):
+                    if result is True:
+                        exported_listings[(
+                            product_data['qty'],
+                            product_data['is_in_stock'] == '1',
+                        )].append(listing)
+                    elif result.get('isFault') is True and \
+                            result['faultCode'] == '101':
+                        # 101: Product does not exist on magento
+                        disabled_listings.append(listing)
+                    else:
+                        # Record the fault and carry on with the other
+                        # products, one product should not stop the sync
+                        exceptions.append({
+                            'origin': '%s,%s' % (listing.__name__, listing.id),
+                            'log': cls.raise_user_error(
+                                'multi_inventory_update_fail',
+                                (result['faultCode'], result['faultMessage']),
+                                raise_exception=False
+                            ),
+                            'channel': channel.id,
+                        })
+
+        # Remember what was exported, so that unchanged inventory need not
+        # be sent again
+        args = []
+        for (quantity, in_stock), listings in exported_listings.iteritems():
+            args.extend([listings, {
+                'magento_exported_quantity': quantity,
+                'magento_exported_in_stock': in_stock,
+            }])
+        if disabled_listings:
+            args.extend([disabled_listings, {'state': 'disabled'}])
+        if args:
+            cls.write(*args)
+
+        if exceptions:
+            ChannelException.create(exceptions)
+
+    @classmethod
+    def mark_magento_inventory_dirty(cls, products):
+        """
+        Mark the magento listings of the products as having inventory to be
+        exported
+
+        :param products: List of active records of products
+        """
+        listings = cls.search([
+            ('product', 'in', map(int, products)),
+            ('channel.source', '=', 'magento'),
+            ('magento_inventory_dirty', '=', False),
+        ])
+        if listings:
+            cls.write(listings, {'magento_inventory_dirty': True})
+
+    @classmethod
+    def export_dirty_magento_inventory(cls):
+        """
+        Export the inventory of the active magento listings whose stock
+        moved since their last export
+
+        :return: List of active records of listings exported
+        """
+        listings = cls.search([
+            ('magento_inventory_dirty', '=', True),
+            ('channel.source', '=', 'magento'),
+            ('state', '=', 'active'),
+        ])
+        if not listings:
+            return []
+
+        cls.write(listings, {'magento_inventory_dirty': False})
+        cls.export_bulk_inventory(listings)
+        return listings
+
+    @classmethod
+    def get_magento_inventory_quantities(cls, listings):
+        """
+        Compute the quantity of the products of all the listings with one
+        stock computation per channel, in the warehouse of the channel.
+
+        :param listings: List of active records of listings
+        :return: Dictionary mapping listing id to quantity
+        """
+        Product = Pool().get('product.product')
+
+        channel_listings = defaultdict(list)
+        for listing in listings:
+            channel_listings[listing.channel].append(listing)
+
+        quantities = {}
+        for channel, listings in channel_listings.iteritems():
+            with Transaction().set_context(locations=[channel.warehouse.id]):
+                product_quantities = Product.get_quantity(
+                    list(set(listing.product for listing in listings)),
+                    'quantity'
+                )
+            for listing in listings:
+                quantities[listing.id] = product_quantities[listing.product.id]
+        return quantities
+
+    def is_magento_inventory_changed(self, product_data):
+        """
+        Check if the inventory in product_data differs from the one last
+        exported to magento for this listing.
+
+        :param product_data: Inventory data to be sent to magento
+        :return: True if the inventory has to be exported again
+        """
+        return (
+            self.magento_exported_quantity != product_data['qty'] or
+            bool(self.magento_exported_in_stock) !=
+            (product_data['is_in_stock'] == '1')
+        )
 
 
 class Product:
@@ -588,19 +847,47 @@ class ProductPriceTier(ModelSQL, ModelView):
             )
         ]
 
-    def get_price(self, name):
+    @classmethod
+    def get_price(cls, tiers, name):
         """Calculate the price of the product for quantity set in record
 
+        :param tiers: List of active records of tiers
         :param name: Name of field
         """
         Channel = Pool().get('sale.channel')
 
         if not Transaction().context.get('current_channel'):
-            return 0
+            return dict((tier.id, 0) for tier in tiers)
 
+        # Fetch the channel once for all the tiers
         channel = Channel.get_current_magento_channel()
-        product = self.product_listing.product
-        return channel.price_list.compute(
-            None, product, product.list_price, self.quantity,
-            channel.default_uom
+        tier_prices = channel.get_magento_tier_prices(
+            list(set(tier.product_listing for tier in tiers))
+        )
+        return dict(
+            (tier.id, dict(tier_prices[tier.product_listing.id])[tier.quantity])
+            for tier in tiers
         )
+
+    @classmethod
+    def delete(cls, tiers):
+        Product = Pool().get('product.product')
+
+        product_ids = set(tier.product_listing.product.id for tier in tiers)
+        super(ProductPriceTier, cls).delete(tiers)
+        # The tier prices of the products changed
+        touch(Product, product_ids)
+
+
+class PriceListLine:
+    "Price List Line"
+    __name__ = 'product.price_list.line'
+
+    @classmethod
+    def delete(cls, lines):
+        PriceList = Pool().get('product.price_list')
+
+        price_list_ids = set(line.price_list.id for line in lines)
+        super(PriceListLine, cls).delete(lines)
+        # Any price computed with the price lists could have changed
+        touch(PriceList, price_list_ids)
@@ -1,19 +1,26 @@
 # -*- coding: utf-8 -*-
 import magento
+import json
+import zlib
 from decimal import Decimal
 import xmlrpclib
 from datetime import datetime
+from dateutil.relativedelta import relativedelta
 import pytz
 
-from trytond.model import fields
+from trytond import backend
+from trytond.model import ModelSQL, fields
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval
 
+from .party import normalize_email
+
 
 __all__ = [
-    'StockShipmentOut', 'Sale', 'SaleLine',
+    'StockShipmentOut', 'Sale', 'SaleLine', 'MagentoOrderCache',
+    'MagentoOrderArchive',
 ]
 __metaclass__ = PoolMeta
 
@@ -22,6 +29,19 @@ INVISIBLE_IF_NOT_MAGENTO = {
 }
 
 
+class MagentoImportBatch(object):
+    """
+    Collects the records created while importing a batch of orders from
+    magento, which are processed together once the whole batch is imported.
+    """
+
+    def __init__(self):
+        #: Values of the contact mechanisms to create
+        self.contact_mechanisms = []
+        #: Active records of the payment transactions to post
+        self.payment_transactions = []
+
+
 class Sale:
     "Sale"
     __name__ = 'sale.sale'
@@ -30,6 +50,25 @@ class Sale:
         'Magento ID', readonly=True, states=INVISIBLE_IF_NOT_MAGENTO,
         depends=['channel_type']
     )
+    #: The state of the sale last exported to magento
+    magento_exported_state = fields.Char(
+        'Magento Exported State', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['channel_type']
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(Sale, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+
+        # Sales updated since the last order status export of a channel
+        table.index_action(['channel', 'write_date'], 'add')
+        # Sales of a channel looked up by the magento increment id
+        table.index_action(['channel', 'reference'], 'add')
 
     @classmethod
     def __setup__(cls):
@@ -82,9 +121,14 @@ class Sale:
         return sales and sales[0] or None
 
     @classmethod
-    def get_sale_using_magento_data(cls, order_data):
+    def get_sale_using_magento_data(cls, order_data, import_batch=None):
         """
         Return an active record of the sale from magento data
+
+        :param order_data: Order data from magento
+        :param import_batch: `MagentoImportBatch` collecting the records to
+                             process once the whole batch of orders is
+                             imported
         """
         Sale = Pool().get('sale.sale')
         Party = Pool().get('party.party')
@@ -117,25 +161,35 @@ class Sale:
                 order_data['shipping_address'] and
                 order_data['shipping_address']['lastname']
             )
-            party = Party.create_using_magento_data({
+            guest_data = {
                 'firstname': firstname,
                 'lastname': lastname,
                 'email': order_data['customer_email'],
                 'customer_id': 0
-            })
+            }
+            party = None
+            if channel.magento_reuse_guest_parties:
+                # Store the email normalized, so that the next order of
+                # this guest can be matched against it.
+                guest_data['email'] = normalize_email(guest_data['email'])
+                party = Party.find_guest_using_magento_data(guest_data)
+            if not party:
+                party = Party.create_using_magento_data(guest_data)
 
         party_invoice_address = None
         if order_data['billing_address']:
             party_invoice_address = \
                 Address.find_or_create_for_party_using_magento_data(
-                    party, order_data['billing_address']
+                    party, order_data['billing_address'],
+                    import_batch=import_batch
                 )
 
         party_shipping_address = None
         if order_data['shipping_address']:
             party_shipping_address = \
                 Address.find_or_create_for_party_using_magento_data(
-                    party, order_data['shipping_address']
+                    party, order_data['shipping_address'],
+                    import_batch=import_batch
                 )
 
         tryton_action = channel.get_tryton_action(order_data['state'])
@@ -172,13 +226,16 @@ class Sale:
         })
 
     @classmethod
-    def create_using_magento_data(cls, order_data):
+    def create_using_magento_data(cls, order_data, import_batch=None):
         """
         Create a sale from magento data. If you wish to override the creation
         process, it is recommended to subclass and manipulate the returned
         unsaved active record from the `get_sale_using_magento_data` method.
 
         :param order_data: Order data from magento
+        :param import_batch: `MagentoImportBatch` collecting the records to
+                             process once the whole batch of orders is
+                             imported
         :return: Active record of record created
         """
         ChannelException = Pool().get('channel.exception')
@@ -193,14 +250,18 @@ class Sale:
         if state_data['action'] == 'do_not_import':
             return
 
-        sale = cls.get_sale_using_magento_data(order_data)
+        sale = cls.get_sale_using_magento_data(
+            order_data, import_batch=import_batch
+        )
         sale.save()
 
         sale.lines = list(sale.lines)
         sale.add_lines_using_magento_data(order_data)
         sale.save()
 
-        sale.create_payment_using_magento_data(order_data['payment'])
+        sale.create_payment_using_magento_data(
+            order_data['payment'], import_batch=import_batch
+        )
 
         # Process sale now
         tryton_action = channel.get_tryton_action(order_data['state'])
@@ -220,9 +281,16 @@ class Sale:
 
         return sale
 
-    def create_payment_using_magento_data(self, payment_data):
+    def create_payment_using_magento_data(
+            self, payment_data, import_batch=None):
         """
         Create sale payment using data magento sent payment data.
+
+        :param payment_data: Payment data from magento
+        :param import_batch: `MagentoImportBatch` collecting the payment
+                             transactions to post once the whole batch of
+                             orders is imported, they are posted right away
+                             if None
         """
         Payment = Pool().get('sale.payment')
         MagentoPaymentGateway = Pool().get('magento.instance.payment_gateway')
@@ -251,8 +319,13 @@ class Sale:
                 }])]
             }])
 
-            for transaction in payment.payment_transactions:
-                transaction.safe_post()
+            if import_batch is not None:
+                import_batch.payment_transactions.extend(
+                    payment.payment_transactions
+                )
+            else:
+                for transaction in payment.payment_transactions:
+                    transaction.safe_post()
 
     def add_lines_using_magento_data(self, order_data):
         """
@@ -357,12 +430,7 @@ class Sale:
         sale = cls.find_using_magento_increment_id(order_increment_id)
 
         if not sale:
-            with magento.Order(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as order_api:
-                order_data = order_api.info(order_increment_id)
-
+            order_data = channel.get_magento_order_data(order_increment_id)
             sale = cls.create_using_magento_data(order_data)
 
         return sale
@@ -435,11 +503,20 @@ class Sale:
         """
         SaleLine = Pool().get('sale.line')
         Channel = Pool().get('sale.channel')
+        SaleChannelCarrier = Pool().get('sale.channel.carrier')
+        Carrier = Pool().get('carrier')
 
         channel = Channel.get_current_magento_channel()
         carrier_data = self.get_carrier_data_from_order_data(order_data)
 
-        magento_carrier = channel.get_shipping_carrier(carrier_data['code'])
+        carriers = SaleChannelCarrier.get_magento_carriers(channel.id)
+        if carrier_data['code'] in carriers:
+            carrier_id = carriers[carrier_data['code']]
+            magento_carrier = carrier_id and Carrier(carrier_id) or None
+        else:
+            magento_carrier = channel.get_shipping_carrier(
+                carrier_data['code']
+            )
 
         if magento_carrier:
             # Save shipping carrier in sale
@@ -495,11 +572,10 @@ class Sale:
 
         channel.validate_magento_channel()
 
-        if channel.magento_order_prefix:
-            # TODO: Use channel_identifier
-            increment_id = self.reference.split(channel.magento_order_prefix)[1]
-        else:
-            increment_id = self.reference
+        call = self.get_magento_order_status_call()
+        if call is None:
+            return self
+
         # This try except is placed because magento might not accept this
         # order status change due to its workflow constraints.
         # TODO: Find a better way to do it
@@ -508,23 +584,43 @@ class Sale:
                 channel.magento_url, channel.magento_api_user,
                 channel.magento_api_key
             ) as order_api:
-                if self.state == 'cancel':
-                    order_api.cancel(increment_id)
-                elif self.state == 'done':
-                    # TODO: update shipping and invoice
-                    order_api.addcomment(increment_id, 'complete')
+                order_api.call(*call)
         except xmlrpclib.Fault, exception:
             if exception.faultCode == 103:
                 return self
 
         return self
 
+    def get_magento_order_status_call(self):
+        """
+        Return the magento API call exporting the order status of this sale.
+
+        :return: [resource path, arguments] for multiCall or None if there
+                 is nothing to export
+        """
+        if not self.magento_id or self.state not in ('cancel', 'done'):
+            return None
+
+        channel = self.channel
+
+        if channel.magento_order_prefix:
+            # TODO: Use channel_identifier
+            increment_id = self.reference.split(channel.magento_order_prefix)[1]
+        else:
+            increment_id = self.reference
+
+        if self.state == 'cancel':
+            return ['sales_order.cancel', [increment_id]]
+        # TODO: update shipping and invoice
+        return ['sales_order.addComment', [increment_id, 'complete']]
+
     @classmethod
     def copy(cls, sales, default=None):
         if default is None:
             default = {}
         default = default.copy()
         default['magento_id'] = None
+        default['magento_exported_state'] = None
         return super(Sale, cls).copy(sales, default=default)
 
     def update_order_status_from_magento(self, order_data=None):
@@ -533,8 +629,6 @@ class Sale:
         :TODO: this only handles complete orders of magento. Should handle
         other states too?
         """
-        Shipment = Pool().get('stock.shipment.out')
-
         if order_data is None:
             # XXX: Magento order_data is already there, so need not to
             # fetch again
@@ -544,20 +638,274 @@ class Sale:
             ) as order_api:
                 order_data = order_api.info(self.reference)
 
-        if order_data['status'] == 'complete':
-            # Order is completed on magento, process shipments and
-            # invoices.
-            for shipment in self.shipments:
-                if shipment.state == 'draft':
-                    Shipment.wait([shipment])
-                if shipment.state == 'waiting':
-                    Shipment.assign([shipment])
-                if shipment.state == 'assigned':
-                    Shipment.pack([shipment])
-                if shipment.state == 'packed':
-                    Shipment.done([shipment])
+        self.update_order_status_using_magento_data([self], [order_data])
+
+    @classmethod
+    def update_order_status_using_magento_data(cls, sales, orders_data):
+        """
+        Update the status of the sales from their order data on magento.
+        This is used by the order status update of the channel for each
+        batch of orders, downstream modules can extend it to handle other
+        states.
+
+        :param sales: List of active records of sales
+        :param orders_data: List of order data from magento, one per sale
+        """
+        # Orders completed on magento, process shipments and invoices.
+        cls.complete_shipments_from_magento([
+            sale for sale, order_data in zip(sales, orders_data)
+            if order_data['status'] == 'complete'
+        ])
+
+        # TODO: handle invoices?
+
+    @classmethod
+    def complete_shipments_from_magento(cls, sales):
+        """
+        Process the shipments of the sales completed on magento until they
+        are done. Each transition is run once for the shipments of all the
+        sales.
+
+        :param sales: List of active records of sales completed on magento
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        shipment_ids = [
+            shipment.id for sale in sales for shipment in sale.shipments
+        ]
+        for state, transition in [
+            ('draft', Shipment.wait),
+            ('waiting', Shipment.assign),
+            ('assigned', Shipment.pack),
+            ('packed', Shipment.done),
+        ]:
+            # Read the states again as the previous transition changed them
+            shipments = [
+                shipment for shipment in Shipment.browse(shipment_ids)
+                if shipment.state == state
+            ]
+            if shipments:
+                transition(shipments)
+
+
+class MagentoOrderCache(ModelSQL):
+    """Magento Order Cache
+
+    Keeps the order data fetched from magento for a short time, so that
+    the order import, the order status update and the lookups by increment
+    id do not download the same orders again.
+    """
+    __name__ = 'sale.channel.magento.order_cache'
+
+    #: Entries older than this are not used anymore
+    timeout = relativedelta(minutes=30)
+    #: Maximum number of entries kept, the oldest are removed first
+    size_limit = 5000
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, readonly=True,
+        ondelete='CASCADE'
+    )
+    increment_id = fields.Char('Increment ID', required=True, readonly=True)
+    updated_at = fields.Char('Updated At', readonly=True)
+    order_data = fields.Text('Order Data', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(MagentoOrderCache, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['channel', 'increment_id'], 'add')
+
+    @classmethod
+    def get_expiry_date(cls):
+        return datetime.utcnow() - cls.timeout
+
+    @classmethod
+    def get_orders_data(cls, channel, keys):
+        """
+        Return the cached order data of the orders.
+
+        :param channel: Active record of the channel
+        :param keys: List of (`increment_id`, `updated_at`), only the order
+                     data of this version of the order is used
+        :return: Dictionary mapping increment id to the order data found
+        """
+        if not keys:
+            return {}
+
+        entries = {}
+        for entry in cls.search([
+            ('channel', '=', channel.id),
+            ('increment_id', 'in', [key[0] for key in keys]),
+            ('create_date', '>=', cls.get_expiry_date()),
+        ], order=[('id', 'ASC')]):
+            entries[(entry.increment_id, entry.updated_at)] = entry
+
+        orders_data = {}
+        for increment_id, updated_at in keys:
+            entry = entries.get((increment_id, updated_at))
+            if entry is not None:
+                orders_data[increment_id] = json.loads(entry.order_data)
+        return orders_data
+
+    @classmethod
+    def set_orders_data(cls, channel, orders_data):
+        """
+        Cache the order data fetched from magento, replacing the data
+        cached earlier for the same orders.
+
+        :param channel: Active record of the channel
+        :param orders_data: List of order data from magento
+        """
+        if not orders_data:
+            return
+
+        increment_ids = [
+            order_data['increment_id'] for order_data in orders_data
+        ]
+        cls.delete(cls.search(['OR', [
+            ('channel', '=', channel.id),
+            ('increment_id', 'in', increment_ids),
+        ], [
+            ('create_date', '<', cls.get_expiry_date()),
+        ]]))
+        cls.create([{
+            'channel': channel.id,
+            'increment_id': order_data['increment_id'],
+            'updated_at': order_data.get('updated_at'),
+            'order_data': json.dumps(order_data),
+        } for order_data in orders_data])
+
+        overflow = cls.search(
+            [], order=[('id', 'DESC')], offset=cls.size_limit
+        )
+        if overflow:
+            cls.delete(overflow)
+
+
+class MagentoOrderArchive(ModelSQL):
+    """Magento Order Archive
 
-            # TODO: handle invoices?
+    Keeps the order data imported from magento compressed, so that the
+    orders can be imported again without downloading them.
+    """
+    __name__ = 'sale.channel.magento.order_archive'
+
+    #: Number of archived orders read at once
+    chunk_size = 100
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, readonly=True,
+        select=True, ondelete='CASCADE'
+    )
+    increment_id = fields.Char('Increment ID', required=True, readonly=True)
+    order_data = fields.Binary('Order Data', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        """
+        Setup the class before adding to pool
+        """
+        super(MagentoOrderArchive, cls).__setup__()
+        cls._sql_constraints += [
+            (
+                'channel_increment_id_unique',
+                'UNIQUE(channel, increment_id)',
+                'An order must be archived only once in a channel',
+            )
+        ]
+
+    @staticmethod
+    def compress(order_data):
+        return zlib.compress(json.dumps(order_data))
+
+    @staticmethod
+    def decompress(value):
+        return json.loads(zlib.decompress(str(value)))
+
+    @classmethod
+    def archive_orders_data(cls, channel, orders_data):
+        """
+        Archive the order data imported from magento, replacing the order
+        data archived earlier for the same orders.
+
+        :param channel: Active record of the channel
+        :param orders_data: List of order data from magento
+        """
+        if not orders_data:
+            return
+
+        archives = dict((archive.increment_id, archive) for archive in (
+            cls.search([
+                ('channel', '=', channel.id),
+                ('increment_id', 'in', [
+                    order_data['increment_id'] for order_data in orders_data
+                ]),
+            ])
+        ))
+
+        to_write = []
+        to_create = []
+        for order_data in orders_data:
+            increment_id = order_data['increment_id']
+            if increment_id in archives:
+                to_write.extend([[archives[increment_id]], {
+                    'order_data': cls.compress(order_data),
+                }])
+            else:
+                to_create.append({
+                    'channel': channel.id,
+                    'increment_id': increment_id,
+                    'order_data': cls.compress(order_data),
+                })
+        if to_write:
+            cls.write(*to_write)
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def get_orders_data(cls, channel, increment_ids=None):
+        """
+        Return the archived order data of the channel.
+
+        :param channel: Active record of the channel
+        :param increment_ids: List of order increment ids, all the archived
+                              orders if None
+        :return: List of order data
+        """
+        return list(cls.iter_orders_data(channel, increment_ids))
+
+    @classmethod
+    def iter_orders_data(cls, channel, increment_ids=None):
+        """
+        Iterate over the archived order data of the channel. The archive is
+        read in chunks ordered by id, so that the whole archive is not
+        loaded at once.
+
+        :param channel: Active record of the channel
+        :param increment_ids: List of order increment ids, all the archived
+                              orders if None
+        :return: Iterator over the order data
+        """
+        domain = [('channel', '=', channel.id)]
+        if increment_ids is not None:
+            domain.append(('increment_id', 'in', increment_ids))
+
+        last_id = 0
+        while True:
+            archives = cls.search(
+                domain + [('id', '>', last_id)], order=[('id', 'ASC')],
+                limit=cls.chunk_size
+            )
+            for archive in archives:
+                yield cls.decompress(archive.order_data)
+            if len(archives) < cls.chunk_size:
+                break
+            last_id = archives[-1].id
 
 
 class SaleLine:
@@ -588,6 +936,20 @@ class StockShipmentOut:
         "Magento Increment ID", readonly=True
     )
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(StockShipmentOut, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+
+        # Shipments not exported yet are searched by the shipment export
+        table.index_action(
+            ['magento_increment_id', 'is_tracking_exported_to_magento'], 'add'
+        )
+
     @staticmethod
     def default_is_tracking_exported_to_magento():
         return False
@@ -596,40 +958,72 @@ class StockShipmentOut:
         """
         Export tracking info to magento for the specified shipment.
 
-        :param shipment: Browse record of shipment
-        :return: Shipment increment ID
+        :return: Shipment increment ID, None if the export failed
+        """
+        if self.export_tracking_infos_to_magento([self]):
+            return self.magento_increment_id
+
+    @classmethod
+    def export_tracking_infos_to_magento(cls, shipments):
+        """
+        Export tracking info to magento for the shipments. The carrier
+        mapping of the channel is loaded once and the tracking numbers are
+        sent in batches over shared sessions.
+
+        :param shipments: List of active records of shipments exported to
+                          magento, having a carrier and a tracking number
+        :return: List of active records of shipments whose tracking info
+                 was exported
         """
-        SaleChannelCarrier = Pool().get('sale.channel.carrier')
         Channel = Pool().get('sale.channel')
-        Shipment = Pool().get('stock.shipment.out')
 
         channel = Channel.get_current_magento_channel()
+        carrier_mappings = channel.get_magento_carrier_mappings()
 
-        assert self.tracking_number
-        assert self.carrier
+        calls = []
+        for shipment in shipments:
+            assert shipment.tracking_number
+            assert shipment.carrier
 
-        try:
-            carrier, = SaleChannelCarrier.search([
-                ('channel', '=', channel.id),
-                ('carrier', '=', self.carrier.id)
-            ])
-        except ValueError:
-            # No mapping carrier found use custom
-            code, title = 'custom', self.carrier.rec_name
-        else:
-            code, title = carrier.get_magento_mapping()
-
-        # Add tracking info to the shipment on magento
-        with magento.Shipment(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as shipment_api:
-            shipment_increment_id = shipment_api.addtrack(
-                self.magento_increment_id, code, title, self.tracking_number
+            code, title = shipment.get_magento_carrier_mapping(
+                channel, carrier_mappings
             )
+            calls.append(['sales_order_shipment.addTrack', [
+                shipment.magento_increment_id, code, title,
+                shipment.tracking_number,
+            ]])
+
+        results = channel.call_magento_multi(
+            magento.Shipment, shipments, calls,
+            channel.magento_tracking_batch_size, 'tracking_export_fail'
+        )
 
-            Shipment.write([self], {
+        exported = [
+            shipment for shipment, result in zip(shipments, results)
+            if not (isinstance(result, dict) and result.get('isFault'))
+        ]
+        if exported:
+            cls.write(exported, {
                 'is_tracking_exported_to_magento': True
             })
+        return exported
 
-        return shipment_increment_id
+    def get_magento_carrier_mapping(self, channel, carrier_mappings=None):
+        """
+        Return the carrier code and title to be sent to magento with the
+        tracking information of this shipment
+
+        :param channel: Active record of the magento channel
+        :param carrier_mappings: Carrier mappings of the channel as returned
+                                 by `get_magento_carrier_mappings`, they are
+                                 loaded if not given
+        :return: (`code`, `title`)
+        """
+        if carrier_mappings is None:
+            carrier_mappings = channel.get_magento_carrier_mappings()
+
+        try:
+            return carrier_mappings[self.carrier.id]
+        except KeyError:
+            # No mapping carrier found use custom
+            return 'custom', self.carrier.rec_name
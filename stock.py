@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+
+__all__ = ['StockMove']
+__metaclass__ = PoolMeta
+
+
+class StockMove:
+    "Stock Move"
+    __name__ = 'stock.move'
+
+    @classmethod
+    def assign(cls, moves):
+        super(StockMove, cls).assign(moves)
+        cls.mark_magento_inventory_dirty(moves)
+
+    @classmethod
+    def do(cls, moves):
+        super(StockMove, cls).do(moves)
+        cls.mark_magento_inventory_dirty(moves)
+
+    @classmethod
+    def cancel(cls, moves):
+        super(StockMove, cls).cancel(moves)
+        cls.mark_magento_inventory_dirty(moves)
+
+    @classmethod
+    def mark_magento_inventory_dirty(cls, moves):
+        """
+        Mark the magento listings of the products moved, so that their
+        inventory gets exported by the next run of the cron
+
+        :param moves: List of active records of moves
+        """
+        Listing = Pool().get('product.product.channel_listing')
+
+        products = list(set(move.product for move in moves))
+        if not products:
+            return
+
+        # The user moving stock need not have access to the listings
+        with Transaction().set_user(0):
+            Listing.mark_magento_inventory_dirty(products)
@@ -225,6 +225,41 @@ class TestParty(TestBase):
             self.assertEqual(len(self.party.addresses), 2)
             self.assertEqual(len(self.party.contact_mechanisms), 1)
 
+    def test0035_create_missing_contact_mechanisms(self):
+        """
+        Test that contact mechanisms collected from magento are created in
+        one batch without duplicates
+        """
+        ContactMechanism = POOL.get('party.contact_mechanism')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+
+            self.setup_defaults()
+
+            ContactMechanism.create([{
+                'party': self.party.id,
+                'type': 'mobile',
+                'value': '123456',
+            }])
+
+            created = ContactMechanism.create_missing_using_magento_data([{
+                'party': self.party.id,
+                'type': 'phone',
+                'value': '123456',
+            }, {
+                'party': self.party.id,
+                'type': 'phone',
+                'value': '654321',
+            }, {
+                'party': self.party.id,
+                'type': 'phone',
+                'value': '654321',
+            }])
+
+            self.assertEqual(len(created), 1)
+            self.assertEqual(created[0].value, '654321')
+            self.assertEqual(len(self.party.contact_mechanisms), 2)
+
     def test0040_match_address(self):
         """
         Tests if address matching works as expected
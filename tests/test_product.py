@@ -28,6 +28,7 @@ def mock_inventory_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.Inventory)
     handle.update.side_effect = lambda id, data: True
+    handle.update_multi.side_effect = lambda data: [True] * len(data)
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -411,6 +412,215 @@ class TestProduct(TestBase):
                 listing.export_inventory()
                 self.assertEqual(listing.state, 'disabled')
 
+    def test_0085_export_only_changed_inventory(self):
+        """
+        Checks that the inventory of a listing is exported again only when
+        it changed, if the channel is configured so
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            self.Channel.write([self.channel1], {
+                'magento_export_changed_inventory_only': True,
+            })
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+
+                category_data = load_json('categories', '17')
+                Category.create_using_magento_data(category_data)
+
+                product_data = load_json('products', '41')
+                product = Product.find_or_create_using_magento_data(
+                    product_data
+                )
+                listing, = product.channel_listings
+                self.assertIsNone(listing.magento_exported_quantity)
+
+                inventory_api = mock_inventory_api()
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory([listing])
+
+                    handle = inventory_api.return_value
+                    self.assertEqual(handle.update_multi.call_count, 1)
+
+                    listing = Listing(listing.id)
+                    self.assertEqual(listing.magento_exported_quantity, 0)
+
+                    # Nothing changed, so nothing is sent this time
+                    Listing.export_bulk_inventory([listing])
+                    self.assertEqual(handle.update_multi.call_count, 1)
+
+    def test_0087_export_inventory_with_faults(self):
+        """
+        Checks that faults sent by magento for some products neither stop
+        the export nor the handling of the other products
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+        ChannelException = POOL.get('channel.exception')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+
+                category_data = load_json('categories', '17')
+                Category.create_using_magento_data(category_data)
+
+                listings = []
+                for product_id in ('41', '135'):
+                    product = Product.find_or_create_using_magento_data(
+                        load_json('products', product_id)
+                    )
+                    listings.extend(product.channel_listings)
+
+                def update_multi(data):
+                    # First product does not exist, second one fails
+                    return [{
+                        'isFault': True,
+                        'faultCode': '101',
+                        'faultMessage': 'Product not exists.',
+                    }, {
+                        'isFault': True,
+                        'faultCode': '102',
+                        'faultMessage': 'Invalid data given.',
+                    }]
+
+                inventory_api = mock_inventory_api()
+                inventory_api.return_value.update_multi.side_effect = \
+                    update_multi
+                with patch('magento.Inventory', inventory_api, create=True):
+                    Listing.export_bulk_inventory(listings)
+
+                listing1, listing2 = Listing.browse(map(int, listings))
+                self.assertEqual(listing1.state, 'disabled')
+                self.assertEqual(listing2.state, 'active')
+
+                exception, = ChannelException.search([])
+                self.assertEqual(exception.origin, listing2)
+                self.assertEqual(exception.channel, self.channel1)
+
+    def test_0088_export_dirty_inventory(self):
+        """
+        Checks that only the listings whose stock moved are exported
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+
+                category_data = load_json('categories', '17')
+                Category.create_using_magento_data(category_data)
+
+                product1 = Product.find_or_create_using_magento_data(
+                    load_json('products', '41')
+                )
+                product2 = Product.find_or_create_using_magento_data(
+                    load_json('products', '135')
+                )
+                listing1, = product1.channel_listings
+                self.assertFalse(listing1.magento_inventory_dirty)
+
+                Listing.mark_magento_inventory_dirty([product1])
+
+                inventory_api = mock_inventory_api()
+                with patch('magento.Inventory', inventory_api, create=True):
+                    exported = Listing.export_dirty_magento_inventory()
+
+                    self.assertEqual(exported, [listing1])
+                    handle = inventory_api.return_value
+                    (product_data_batch,), _ = handle.update_multi.call_args
+                    self.assertEqual(len(product_data_batch), 1)
+
+                    listing1 = Listing(listing1.id)
+                    self.assertFalse(listing1.magento_inventory_dirty)
+
+                    # Nothing moved since
+                    self.assertEqual(
+                        Listing.export_dirty_magento_inventory(), []
+                    )
+                self.assertFalse(
+                    product2.channel_listings[0].magento_inventory_dirty
+                )
+
+    def test_0089_export_inventory_of_moved_stock(self):
+        """
+        Checks that moving stock marks the listings of the product and that
+        the cron exports only these listings
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+        Move = POOL.get('stock.move')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+
+                category_data = load_json('categories', '17')
+                Category.create_using_magento_data(category_data)
+
+                product1 = Product.find_or_create_using_magento_data(
+                    load_json('products', '41')
+                )
+                product2 = Product.find_or_create_using_magento_data(
+                    load_json('products', '135')
+                )
+                listing1, = product1.channel_listings
+                listing2, = product2.channel_listings
+
+                lost_found, = self.Location.search([
+                    ('type', '=', 'lost_found')
+                ])
+                move, = Move.create([{
+                    'product': product1.id,
+                    'uom': product1.default_uom.id,
+                    'quantity': 5,
+                    'from_location': lost_found.id,
+                    'to_location': self.warehouse.storage_location.id,
+                    'company': self.company.id,
+                }])
+                self.assertFalse(Listing(listing1.id).magento_inventory_dirty)
+
+                Move.do([move])
+
+                self.assertTrue(Listing(listing1.id).magento_inventory_dirty)
+                self.assertFalse(Listing(listing2.id).magento_inventory_dirty)
+
+                inventory_api = mock_inventory_api()
+                with patch('magento.Inventory', inventory_api, create=True):
+                    self.Channel.export_inventory_to_magento_using_cron()
+
+                handle = inventory_api.return_value
+                (product_data_batch,), _ = handle.update_multi.call_args
+                self.assertEqual(product_data_batch, [[
+                    listing1.product_identifier,
+                    {'qty': 5, 'is_in_stock': '1'},
+                ]])
+                self.assertFalse(Listing(listing1.id).magento_inventory_dirty)
+
     def test_0090_tier_prices(self):
         """Checks the function field on product price tiers
         """
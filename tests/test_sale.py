@@ -4,6 +4,7 @@ import os
 from decimal import Decimal
 
 import unittest
+import xmlrpclib
 from datetime import datetime
 import pytz
 from dateutil.relativedelta import relativedelta
@@ -12,6 +13,7 @@ import magento
 from mock import patch, MagicMock
 import trytond.tests.test_tryton
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from test_base import TestBase, load_json
 
@@ -46,6 +48,7 @@ def mock_order_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.Order)
     handle.info.side_effect = lambda id: load_json('orders', str(id))
+    handle.multiCall.side_effect = lambda calls: [True] * len(calls)
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -75,6 +78,7 @@ def mock_shipment_api(mock=None, data=None):
     handle = MagicMock(spec=magento.Shipment)
     handle.create.side_effect = lambda *args, **kwargs: 'Shipment created'
     handle.addtrack.side_effect = lambda *args, **kwargs: True
+    handle.multiCall.side_effect = lambda calls: [True] * len(calls)
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -89,6 +93,22 @@ def mock_tier_price_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.ProductTierPrice)
     handle.update.side_effect = lambda *args, **kwargs: 'Prices Exported'
+    handle.multiCall.side_effect = lambda calls: [True] * len(calls)
+    if data is None:
+        handle.__enter__.return_value = handle
+    else:
+        handle.__enter__.return_value = data
+    mock.return_value = handle
+    return mock
+
+
+def mock_order_config_api(mock=None, data=None):
+    if mock is None:
+        mock = MagicMock()
+
+    handle = MagicMock()
+    handle.get_shipping_methods.side_effect = \
+        lambda: load_json('carriers', 'shipping_methods')
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -113,6 +133,65 @@ class TestSale(TestBase):
             for code, name in order_states_list.iteritems():
                 channel.create_order_state(code, name)
 
+    def create_shipments(self, increment_ids):
+        """
+        Import the orders of the current channel and process them
+
+        :return: List of the waiting shipments, in the order of the orders
+        """
+        Sale = POOL.get('sale.sale')
+        Party = POOL.get('party.party')
+        Category = POOL.get('product.category')
+        Shipment = POOL.get('stock.shipment.out')
+
+        order_states_list = load_json('order-states', 'all')
+        for code, name in order_states_list.iteritems():
+            self.channel1.create_order_state(code, name)
+
+        category_tree = load_json('categories', 'category_tree')
+        Category.create_tree_using_magento_data(category_tree)
+
+        orders = []
+        for increment_id in increment_ids:
+            order_data = load_json('orders', increment_id)
+
+            with patch('magento.Customer', mock_customer_api(), create=True):
+                Party.find_or_create_using_magento_id(
+                    order_data['customer_id']
+                )
+
+            with Transaction().set_context(company=self.company):
+                with patch(
+                        'magento.Product', mock_product_api(), create=True):
+                    orders.append(
+                        Sale.find_or_create_using_magento_data(order_data)
+                    )
+
+        Sale.write(orders, {'invoice_method': 'manual'})
+        orders = Sale.browse(map(int, orders))
+        Sale.confirm(orders)
+        with Transaction().set_user(0, set_context=True):
+            Sale.process(orders)
+
+        shipments = []
+        for order in orders:
+            shipments.extend(Shipment.search([('moves.sale', '=', order.id)]))
+        return shipments
+
+    def create_done_shipments(self, increment_ids):
+        """
+        Import the orders of the current channel and ship them
+
+        :return: List of the done shipments, in the order of the orders
+        """
+        Shipment = POOL.get('stock.shipment.out')
+
+        shipments = self.create_shipments(increment_ids)
+        Shipment.assign(shipments)
+        Shipment.pack(shipments)
+        Shipment.done(shipments)
+        return Shipment.browse(map(int, shipments))
+
     def test_0005_import_sale_order_states(self):
         """
         Test the import and creation of sale order states for an channel
@@ -257,6 +336,130 @@ class TestSale(TestBase):
 
                 self.assertTrue(carriers_after_import > carriers_before_import)
 
+    def test_0021_import_carriers_creates_missing_codes(self):
+        """
+        Tests that importing the carriers creates only the codes which the
+        channel does not have yet, each of them once
+        """
+        SaleChannelCarrier = POOL.get('sale.channel.carrier')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            # The flatrate carrier exists already and dhlint is sent twice
+            carriers_data = load_json('carriers', 'shipping_methods')
+            carriers_data.append({'code': 'dhlint', 'label': 'DHL'})
+            order_config_api = mock_order_config_api()
+            order_config_api.return_value.get_shipping_methods.side_effect = \
+                lambda: carriers_data
+
+            with patch(
+                'trytond.modules.magento.channel.OrderConfig',
+                order_config_api
+            ):
+                self.Channel.import_shipping_carriers([self.channel1])
+
+                carriers = SaleChannelCarrier.search([
+                    ('channel', '=', self.channel1.id),
+                ], order=[('code', 'ASC')])
+                self.assertEqual(
+                    [carrier.code for carrier in carriers],
+                    ['dhlint', 'flatrate', 'googlecheckout']
+                )
+                self.assertEqual(
+                    SaleChannelCarrier.get_magento_carriers(self.channel1.id),
+                    {'dhlint': None, 'flatrate': None, 'googlecheckout': None}
+                )
+
+                # Importing again does not create anything
+                self.Channel.import_shipping_carriers([self.channel1])
+                self.assertEqual(SaleChannelCarrier.search([
+                    ('channel', '=', self.channel1.id),
+                ], count=True), 3)
+
+    def test_0022_import_order_uses_changed_carrier_mapping(self):
+        """
+        Tests that changing the carrier of a channel carrier clears the
+        cached carriers and the next imported order uses the new carrier
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+        Carrier = POOL.get('carrier')
+        ProductTemplate = POOL.get('product.template')
+        SaleChannelCarrier = POOL.get('sale.channel.carrier')
+        Uom = POOL.get('product.uom')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                def import_order(increment_id):
+                    order_data = load_json('orders', increment_id)
+
+                    with patch(
+                            'magento.Customer', mock_customer_api(),
+                            create=True):
+                        self.Party.find_or_create_using_magento_id(
+                            order_data['customer_id']
+                        )
+
+                    with Transaction().set_context(company=self.company):
+                        with patch(
+                                'magento.Product', mock_product_api(),
+                                create=True):
+                            return Sale.find_or_create_using_magento_data(
+                                order_data
+                            )
+
+                # Both orders are shipped with flatrate, which is not mapped
+                # to a carrier yet
+                sale = import_order('100000001')
+                self.assertIsNone(sale.carrier)
+                self.assertEqual(
+                    SaleChannelCarrier.get_magento_carriers(self.channel1.id),
+                    {'flatrate': None}
+                )
+
+                uom, = Uom.search([('name', '=', 'Unit')], limit=1)
+                product, = ProductTemplate.create([{
+                    'name': 'Shipping product',
+                    'type': 'service',
+                    'account_expense': self.get_account_by_kind('expense'),
+                    'account_revenue': self.get_account_by_kind('revenue'),
+                    'default_uom': uom.id,
+                    'sale_uom': uom.id,
+                    'products': [('create', [{
+                        'code': 'code',
+                        'description': 'This is a product description',
+                        'list_price': Decimal('100'),
+                        'cost_price': Decimal('1'),
+                    }])]
+                }])
+                carrier, = Carrier.create([{
+                    'party': self.Party.search([], limit=1)[0].id,
+                    'carrier_product': product.products[0].id,
+                }])
+                flatrate, = SaleChannelCarrier.search([
+                    ('channel', '=', self.channel1.id),
+                    ('code', '=', 'flatrate'),
+                ])
+                SaleChannelCarrier.write([flatrate], {
+                    'carrier': carrier.id,
+                })
+
+                sale = import_order('100000002')
+                self.assertEqual(sale.carrier, carrier)
+                self.assertEqual(
+                    SaleChannelCarrier.get_magento_carriers(self.channel1.id),
+                    {'flatrate': carrier.id}
+                )
+
     def test_0030_import_sale_order_with_products_with_new(self):
         """
         Tests import of sale order using magento data with magento state as new
@@ -405,6 +608,59 @@ class TestSale(TestBase):
                     len(order.lines), len(order_data['items']) + 1
                 )
 
+    def test_0034_import_guest_sale_orders_reusing_party(self):
+        """
+        Tests that guest orders with the same email share a party when the
+        channel is configured to reuse guest customers
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            self.Channel.write([self.channel1], {
+                'magento_reuse_guest_parties': True,
+            })
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                order_data = load_json('orders', '100000001')
+                order_data['customer_id'] = None
+
+                with Transaction().set_context(company=self.company):
+                    with patch(
+                            'magento.Product', mock_product_api(), create=True):
+                        order1 = Sale.find_or_create_using_magento_data(
+                            order_data
+                        )
+
+                        # Same guest orders again with a differently
+                        # cased email
+                        order_data = load_json('orders', '100000002')
+                        order_data['order_id'] = '2'
+                        order_data['customer_id'] = None
+                        order_data['customer_email'] = \
+                            order_data['customer_email'].upper()
+                        order2 = Sale.find_or_create_using_magento_data(
+                            order_data
+                        )
+
+                self.assertNotEqual(order1, order2)
+                self.assertEqual(order1.party, order2.party)
+                self.assertEqual(
+                    len([
+                        c for c in order1.party.contact_mechanisms
+                        if c.type == 'email'
+                    ]), 1
+                )
+
     def test_0035_import_sale_order_with_products_with_processing(self):
         """
         Tests import of sale order using magento data with magento state as
@@ -506,6 +762,167 @@ class TestSale(TestBase):
                     len(order.lines), len(order_data['items']) + 1
                 )
 
+    def test_0045_magento_order_cache(self):
+        """
+        Tests that the order data fetched from magento is cached by version
+        """
+        OrderCache = POOL.get('sale.channel.magento.order_cache')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            order_data = load_json('orders', '100000001')
+            increment_id = order_data['increment_id']
+
+            OrderCache.set_orders_data(self.channel1, [order_data])
+
+            self.assertEqual(
+                OrderCache.get_orders_data(
+                    self.channel1, [(increment_id, order_data['updated_at'])]
+                ),
+                {increment_id: order_data}
+            )
+            # The order data is not used without its version
+            self.assertEqual(
+                OrderCache.get_orders_data(
+                    self.channel1, [(increment_id, None)]
+                ),
+                {}
+            )
+            # Another version of the order is not in the cache
+            self.assertEqual(
+                OrderCache.get_orders_data(
+                    self.channel1, [(increment_id, '2013-07-01 10:00:00')]
+                ),
+                {}
+            )
+            self.assertEqual(
+                OrderCache.get_orders_data(
+                    self.channel2, [(increment_id, order_data['updated_at'])]
+                ),
+                {}
+            )
+
+            # The order data is replaced when cached again
+            OrderCache.set_orders_data(self.channel1, [order_data])
+            self.assertEqual(len(OrderCache.search([])), 1)
+
+            with patch('magento.Order', mock_order_api(), create=True):
+                self.assertEqual(
+                    self.channel1.get_magento_order_data(
+                        increment_id, order_data['updated_at']
+                    ),
+                    order_data
+                )
+                self.assertFalse(magento.Order.called)
+
+            # Without its version, the order is fetched from magento
+            with patch('magento.Order', mock_order_api(), create=True):
+                self.assertEqual(
+                    self.channel1.get_magento_order_data(increment_id),
+                    order_data
+                )
+                magento.Order.return_value.info.assert_called_once_with(
+                    increment_id
+                )
+
+    def test_0046_reimport_order_from_archive(self):
+        """
+        Tests that archived orders are imported again without magento
+        """
+        Sale = POOL.get('sale.sale')
+        Party = POOL.get('party.party')
+        Category = POOL.get('product.category')
+        OrderArchive = POOL.get('sale.channel.magento.order_archive')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                order_data = load_json('orders', '100000001')
+
+                with patch(
+                        'magento.Customer', mock_customer_api(), create=True):
+                    Party.find_or_create_using_magento_id(
+                        order_data['customer_id']
+                    )
+
+                OrderArchive.archive_orders_data(self.channel1, [order_data])
+                # Archiving again replaces the archived order
+                OrderArchive.archive_orders_data(self.channel1, [order_data])
+                self.assertEqual(len(OrderArchive.search([])), 1)
+                self.assertEqual(
+                    OrderArchive.get_orders_data(self.channel1),
+                    [order_data]
+                )
+
+                with Transaction().set_context(company=self.company):
+                    with patch('magento.Order', mock_order_api(), create=True):
+                        with patch(
+                            'magento.Product', mock_product_api(),
+                            create=True
+                        ):
+                            sales = self.channel1.reimport_from_archive()
+                            self.assertFalse(magento.Order.called)
+
+                self.assertEqual(len(sales), 1)
+                self.assertEqual(
+                    sales[0].magento_id, int(order_data['order_id'])
+                )
+
+                # The sale is not created twice
+                with Transaction().set_context(company=self.company):
+                    self.assertEqual(
+                        self.channel1.reimport_from_archive(), sales
+                    )
+                self.assertEqual(len(Sale.search([])), 1)
+
+    def test_0047_read_order_archive_in_chunks(self):
+        """
+        Tests that the archived orders are read in chunks ordered by id
+        """
+        OrderArchive = POOL.get('sale.channel.magento.order_archive')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            orders_data = [
+                load_json('orders', '100000001'),
+                load_json('orders', '100000002'),
+                load_json('orders', '100000004'),
+            ]
+            OrderArchive.archive_orders_data(self.channel1, orders_data)
+
+            with patch.object(OrderArchive, 'chunk_size', 2):
+                with patch.object(
+                    OrderArchive, 'search', wraps=OrderArchive.search
+                ) as search:
+                    self.assertEqual(
+                        list(OrderArchive.iter_orders_data(self.channel1)),
+                        orders_data
+                    )
+                    self.assertEqual(search.call_count, 2)
+
+                    search.reset_mock()
+                    self.assertEqual(
+                        OrderArchive.get_orders_data(
+                            self.channel1, ['100000002', '100000004']
+                        ),
+                        orders_data[1:]
+                    )
+                    # The last chunk is full, an empty chunk ends the reads
+                    self.assertEqual(search.call_count, 2)
+
+            self.assertEqual(
+                OrderArchive.get_orders_data(self.channel2), []
+            )
+
     def test_0050_export_order_status_to_magento(self):
         """
         Tests if order status is exported to magento
@@ -554,6 +971,158 @@ class TestSale(TestBase):
                     self.assertEqual(len(order_exported), 1)
                     self.assertEqual(order_exported[0], order)
 
+    def test_0054_channel_batch_sizes_must_be_positive(self):
+        """
+        Tests that the batch sizes and the API concurrency of a magento
+        channel cannot be zero or negative
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            for field_name in [
+                'magento_api_concurrency',
+                'magento_inventory_batch_size',
+                'magento_tier_price_batch_size',
+                'magento_order_status_batch_size',
+                'magento_tracking_batch_size',
+            ]:
+                for value in (0, -1):
+                    self.assertRaises(
+                        UserError, self.Channel.write,
+                        [self.channel1], {field_name: value}
+                    )
+                self.Channel.write([self.channel1], {field_name: 10})
+
+    def test_0055_export_cancelled_order_status_to_magento(self):
+        """
+        Tests if the status of cancelled orders is sent to magento in one
+        multiCall
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                order_data = load_json('orders', '100000001')
+
+                with patch(
+                        'magento.Customer', mock_customer_api(), create=True):
+                    self.Party.find_or_create_using_magento_id(
+                        order_data['customer_id']
+                    )
+
+                with Transaction().set_context(company=self.company):
+                    # Create sale order using magento data
+                    with patch(
+                            'magento.Product', mock_product_api(), create=True):
+                        order = Sale.find_or_create_using_magento_data(
+                            order_data
+                        )
+
+                Sale.write([order], {'state': 'cancel'})
+
+                order_api = mock_order_api()
+                with patch('magento.Order', order_api, create=True):
+                    order_exported = self.channel1.export_order_status()
+
+                self.assertEqual(order_exported, [order])
+                order_api.return_value.multiCall.assert_called_once_with([
+                    ['sales_order.cancel', [order_data['increment_id']]],
+                ])
+
+    def test_0056_export_order_status_retries_failed_sales(self):
+        """
+        Tests that the order status export sends only the sales of the
+        channel and sends again the sales magento did not accept
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+        ChannelException = POOL.get('channel.exception')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                order_data = load_json('orders', '100000001')
+
+                with patch(
+                        'magento.Customer', mock_customer_api(), create=True):
+                    self.Party.find_or_create_using_magento_id(
+                        order_data['customer_id']
+                    )
+
+                with Transaction().set_context(company=self.company):
+                    with patch(
+                            'magento.Product', mock_product_api(), create=True):
+                        order = Sale.find_or_create_using_magento_data(
+                            order_data
+                        )
+
+                # The same order cancelled on the other channel
+                other_order, = Sale.copy([order], {
+                    'channel': self.channel2.id,
+                })
+                Sale.write([order, other_order], {
+                    'state': 'cancel',
+                    'magento_id': order.magento_id,
+                })
+
+                order_api = mock_order_api()
+                order_api.return_value.multiCall.side_effect = \
+                    lambda calls: [{
+                        'isFault': True,
+                        'faultCode': '104',
+                        'faultMessage': 'Cannot cancel the order.',
+                    }] * len(calls)
+                with patch('magento.Order', order_api, create=True):
+                    self.assertEqual(
+                        self.channel1.export_order_status(), [order]
+                    )
+                order_api.return_value.multiCall.assert_called_once_with([
+                    ['sales_order.cancel', [order_data['increment_id']]],
+                ])
+                self.assertIsNone(Sale(order.id).magento_exported_state)
+                self.assertIsNone(Sale(other_order.id).magento_exported_state)
+                self.assertEqual(
+                    ChannelException.search([
+                        ('origin', '=', 'sale.sale,%s' % order.id),
+                    ], count=True), 1
+                )
+
+                # The failed sale is sent again by the next export
+                self.assertTrue(self.channel1.last_order_export_time)
+                order_api = mock_order_api()
+                with patch('magento.Order', order_api, create=True):
+                    self.assertEqual(
+                        self.channel1.export_order_status(), [order]
+                    )
+                self.assertEqual(
+                    Sale(order.id).magento_exported_state, 'cancel'
+                )
+
+                # Nothing is sent again once the state is exported
+                order_api = mock_order_api()
+                with patch('magento.Order', order_api, create=True):
+                    self.assertEqual(self.channel1.export_order_status(), [])
+                self.assertFalse(order_api.return_value.multiCall.called)
+                self.assertIsNone(Sale(other_order.id).magento_exported_state)
+
     def test_0060_export_order_status_with_last_order_export_time_case1(self):
         """
         Tests that sale cannot be exported if last order export time is
@@ -683,38 +1252,519 @@ class TestSale(TestBase):
                     }]
                 )
 
-                # Create carrier
-                carrier, = Carrier.create([{
-                    'party': party.id,
-                    'carrier_product': product.products[0].id,
-                }])
-                SaleChannelCarrier.write([mag_carriers[0]], {
-                    'carrier': carrier.id,
-                })
+                # Create carrier
+                carrier, = Carrier.create([{
+                    'party': party.id,
+                    'carrier_product': product.products[0].id,
+                }])
+                SaleChannelCarrier.write([mag_carriers[0]], {
+                    'carrier': carrier.id,
+                })
+
+                Sale.write([order], {'invoice_method': 'manual'})
+                order = Sale(order.id)
+                Sale.confirm([order])
+                with Transaction().set_user(0, set_context=True):
+                    Sale.process([order])
+                shipment, = Shipment.search([])
+
+                Shipment.assign([shipment])
+                Shipment.pack([shipment])
+                Shipment.done([shipment])
+
+                shipment = Shipment(shipment.id)
+
+                self.assertFalse(shipment.magento_increment_id)
+
+                with patch(
+                    'magento.Shipment', mock_shipment_api(), create=True
+                ):
+
+                    self.channel1.export_shipment_status_to_magento()
+
+                    shipment = Shipment(shipment.id)
+                    self.assertTrue(shipment.magento_increment_id)
+
+    def test_0051_export_shipments_with_existing_magento_shipment(self):
+        """
+        Tests that the shipments are exported in a batch and that a shipment
+        which already exists on magento does not stop the others
+        """
+        Shipment = POOL.get('stock.shipment.out')
+        ChannelException = POOL.get('channel.exception')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                shipments = self.create_done_shipments(
+                    ['100000001', '100000002']
+                )
+                self.assertEqual(len(shipments), 2)
+
+                def create(order_increment_id, items_qty):
+                    if order_increment_id == '100000001':
+                        raise xmlrpclib.Fault(
+                            102, 'Cannot do shipment for the order.'
+                        )
+                    return 'shipment-%s' % order_increment_id
+
+                shipment_api = mock_shipment_api()
+                shipment_api.return_value.create.side_effect = create
+
+                with patch('magento.Shipment', shipment_api, create=True):
+                    updated_sales = \
+                        self.channel1.export_shipment_status_to_magento()
+
+                self.assertEqual(
+                    shipment_api.return_value.create.call_count, 2
+                )
+                self.assertEqual(
+                    set(sale.reference for sale in updated_sales),
+                    set(['mag_100000001', 'mag_100000002'])
+                )
+
+                shipments = Shipment.browse(map(int, shipments))
+                self.assertIsNone(shipments[0].magento_increment_id)
+                self.assertEqual(
+                    shipments[1].magento_increment_id, 'shipment-100000002'
+                )
+                # An existing shipment is not an error
+                self.assertEqual(ChannelException.search([], count=True), 0)
+
+                # Another fault is recorded once on the shipment, which is
+                # sent again by the next exports
+                self.channel1.last_shipment_export_time = None
+                self.channel1.save()
+                shipment_api = mock_shipment_api()
+                shipment_api.return_value.create.side_effect = \
+                    xmlrpclib.Fault(104, 'Shipment could not be created.')
+                with patch('magento.Shipment', shipment_api, create=True):
+                    self.channel1.export_shipment_status_to_magento()
+                    self.channel1.export_shipment_status_to_magento()
+
+                self.assertEqual(
+                    shipment_api.return_value.create.call_count, 2
+                )
+                self.assertIsNone(
+                    Shipment(shipments[0].id).magento_increment_id
+                )
+                exception, = ChannelException.search([])
+                self.assertEqual(exception.origin, shipments[0])
+
+    def test_0052_export_tracking_infos_to_magento(self):
+        """
+        Tests that the tracking info of the shipments is exported in a batch
+        and that a failed shipment is left to be exported again
+        """
+        Party = POOL.get('party.party')
+        Carrier = POOL.get('carrier')
+        ProductTemplate = POOL.get('product.template')
+        SaleChannelCarrier = POOL.get('sale.channel.carrier')
+        Shipment = POOL.get('stock.shipment.out')
+        ChannelException = POOL.get('channel.exception')
+        Uom = POOL.get('product.uom')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                shipments = self.create_done_shipments(
+                    ['100000001', '100000002']
+                )
+                Shipment.write(
+                    [shipments[0]], {'magento_increment_id': 'S1'},
+                    [shipments[1]], {'magento_increment_id': 'S2'},
+                )
+
+                uom, = Uom.search([('name', '=', 'Unit')], limit=1)
+                product, = ProductTemplate.create([{
+                    'name': 'Shipping product',
+                    'type': 'service',
+                    'account_expense': self.get_account_by_kind('expense'),
+                    'account_revenue': self.get_account_by_kind('revenue'),
+                    'default_uom': uom.id,
+                    'sale_uom': uom.id,
+                    'products': [('create', [{
+                        'code': 'code',
+                        'description': 'This is a product description',
+                        'list_price': Decimal('100'),
+                        'cost_price': Decimal('1'),
+                    }])]
+                }])
+                party, = Party.search([], limit=1)
+                carrier, = Carrier.create([{
+                    'party': party.id,
+                    'carrier_product': product.products[0].id,
+                }])
+                mag_carrier, = SaleChannelCarrier.create([{
+                    'name': 'Flat Rate',
+                    'code': 'flatrate',
+                    'channel': self.channel1.id,
+                    'carrier': carrier.id,
+                }])
+
+                shipments = Shipment.browse(map(int, shipments))
+                for shipment, tracking_number in zip(
+                        shipments, ['TRACK1', 'TRACK2']):
+                    shipment.carrier = carrier
+                    shipment.tracking_number = tracking_number
+
+                shipment_api = mock_shipment_api()
+                shipment_api.return_value.multiCall.side_effect = \
+                    lambda calls: [True, {
+                        'isFault': True,
+                        'faultCode': '100',
+                        'faultMessage': 'Requested shipment not exists.',
+                    }]
+
+                with patch('magento.Shipment', shipment_api, create=True):
+                    exported = Shipment.export_tracking_infos_to_magento(
+                        shipments
+                    )
+
+                code, title = mag_carrier.get_magento_mapping()
+                shipment_api.return_value.multiCall.assert_called_once_with([
+                    ['sales_order_shipment.addTrack', [
+                        'S1', code, title, 'TRACK1'
+                    ]],
+                    ['sales_order_shipment.addTrack', [
+                        'S2', code, title, 'TRACK2'
+                    ]],
+                ])
+                self.assertEqual(exported, [shipments[0]])
+
+                shipments = Shipment.browse(map(int, shipments))
+                self.assertTrue(shipments[0].is_tracking_exported_to_magento)
+                self.assertFalse(shipments[1].is_tracking_exported_to_magento)
+                self.assertEqual(ChannelException.search([], count=True), 1)
+
+    def test_0057_export_shipment_tracking_retries_failed_shipments(self):
+        """
+        Tests that the channel sends the tracking info of a failed shipment
+        again with the next export only, and records its failure once
+        """
+        Party = POOL.get('party.party')
+        Carrier = POOL.get('carrier')
+        ProductTemplate = POOL.get('product.template')
+        SaleChannelCarrier = POOL.get('sale.channel.carrier')
+        Shipment = POOL.get('stock.shipment.out')
+        ChannelException = POOL.get('channel.exception')
+        Uom = POOL.get('product.uom')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                shipments = self.create_done_shipments(
+                    ['100000001', '100000002']
+                )
+
+                uom, = Uom.search([('name', '=', 'Unit')], limit=1)
+                product, = ProductTemplate.create([{
+                    'name': 'Shipping product',
+                    'type': 'service',
+                    'account_expense': self.get_account_by_kind('expense'),
+                    'account_revenue': self.get_account_by_kind('revenue'),
+                    'default_uom': uom.id,
+                    'sale_uom': uom.id,
+                    'products': [('create', [{
+                        'code': 'code',
+                        'description': 'This is a product description',
+                        'list_price': Decimal('100'),
+                        'cost_price': Decimal('1'),
+                    }])]
+                }])
+                party, = Party.search([], limit=1)
+                carrier, = Carrier.create([{
+                    'party': party.id,
+                    'carrier_product': product.products[0].id,
+                }])
+                flatrate, = SaleChannelCarrier.search([
+                    ('channel', '=', self.channel1.id),
+                    ('code', '=', 'flatrate'),
+                ])
+                SaleChannelCarrier.write([flatrate], {
+                    'carrier': carrier.id,
+                })
+
+                Shipment.write([shipments[0]], {
+                    'magento_increment_id': 'S1',
+                    'carrier': carrier.id,
+                    'tracking_number': 'TRACK1',
+                }, [shipments[1]], {
+                    'magento_increment_id': 'S2',
+                    'carrier': carrier.id,
+                    'tracking_number': 'TRACK2',
+                })
+
+                fault = {
+                    'isFault': True,
+                    'faultCode': '100',
+                    'faultMessage': 'Requested shipment not exists.',
+                }
+
+                def export_tracking(since, results):
+                    shipment_api = mock_shipment_api()
+                    shipment_api.return_value.multiCall.side_effect = \
+                        lambda calls: results[:len(calls)]
+                    with patch('magento.Shipment', shipment_api, create=True):
+                        exported = self.Channel(
+                            self.channel1.id
+                        ).export_shipment_tracking_to_magento(since)
+                    return exported, shipment_api.return_value.multiCall
+
+                # The failed shipment is touched to the watermark of the
+                # next export
+                watermark = datetime.utcnow() + relativedelta(days=1)
+                self.channel1.last_shipment_export_time = watermark
+                self.channel1.save()
+
+                exported, multi_call = export_tracking(None, [True, fault])
+                self.assertEqual(exported, [shipments[0]])
+                self.assertEqual(len(multi_call.call_args[0][0]), 2)
+
+                # It is sent again by the next export
+                exported, multi_call = export_tracking(watermark, [fault])
+                self.assertEqual(exported, [])
+                self.assertEqual(
+                    multi_call.call_args[0][0][0][1][0], 'S2'
+                )
+
+                # But not by the ones after it, unless it is written again
+                exported, multi_call = export_tracking(
+                    watermark + relativedelta(seconds=1), [fault]
+                )
+                self.assertEqual(exported, [])
+                self.assertFalse(multi_call.called)
+
+                shipments = Shipment.browse(map(int, shipments))
+                self.assertTrue(shipments[0].is_tracking_exported_to_magento)
+                self.assertFalse(shipments[1].is_tracking_exported_to_magento)
+                self.assertEqual(ChannelException.search([], count=True), 1)
+
+    def test_0053_export_shipment_status_using_cron(self):
+        """
+        Tests that the cron exports the shipments of every magento channel
+        and reports the failure of a channel
+        """
+        Channel = POOL.get('sale.channel')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            channel_count = Channel.search(
+                [('source', '=', 'magento')], count=True
+            )
+            self.assertEqual(channel_count, 2)
+
+            with patch.object(
+                Channel, 'export_shipment_status_to_magento'
+            ) as export_shipment_status:
+                Channel.export_shipment_status_to_magento_using_cron()
+                self.assertEqual(
+                    export_shipment_status.call_count, channel_count
+                )
+
+                # The failure is raised after all the channels are exported
+                export_shipment_status.reset_mock()
+                export_shipment_status.side_effect = xmlrpclib.Fault(
+                    1, 'Internal Error'
+                )
+                with self.assertRaises(xmlrpclib.Fault):
+                    Channel.export_shipment_status_to_magento_using_cron()
+                self.assertEqual(
+                    export_shipment_status.call_count, channel_count
+                )
 
-                Sale.write([order], {'invoice_method': 'manual'})
-                order = Sale(order.id)
-                Sale.confirm([order])
-                with Transaction().set_user(0, set_context=True):
-                    Sale.process([order])
-                shipment, = Shipment.search([])
+            # The channels are unlocked once exported
+            self.assertTrue(self.channel1.lock_magento_channel())
+            self.channel1.unlock_magento_channel()
 
-                Shipment.assign([shipment])
-                Shipment.pack([shipment])
-                Shipment.done([shipment])
+    def test_0065_update_order_status_of_updated_orders(self):
+        """
+        Tests that the order status update fetches only the orders updated
+        on magento since the last update and matches them to their sales
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+        OrderCache = POOL.get('sale.channel.magento.order_cache')
 
-                shipment = Shipment(shipment.id)
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+            self.Channel.write([self.channel1], {
+                'magento_order_prefix': 'shop-',
+            })
 
-                self.assertFalse(shipment.magento_increment_id)
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
 
-                with patch(
-                    'magento.Shipment', mock_shipment_api(), create=True
-                ):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
 
-                    self.channel1.export_shipment_status_to_magento()
+                sales = []
+                for increment_id in ('100000001', '100000002'):
+                    order_data = load_json('orders', increment_id)
 
-                    shipment = Shipment(shipment.id)
-                    self.assertTrue(shipment.magento_increment_id)
+                    with patch(
+                            'magento.Customer', mock_customer_api(),
+                            create=True):
+                        self.Party.find_or_create_using_magento_id(
+                            order_data['customer_id']
+                        )
+
+                    with Transaction().set_context(company=self.company):
+                        with patch(
+                                'magento.Product', mock_product_api(),
+                                create=True):
+                            sales.append(
+                                Sale.find_or_create_using_magento_data(
+                                    order_data
+                                )
+                            )
+                self.assertEqual(
+                    [sale.reference for sale in sales],
+                    ['shop-100000001', 'shop-100000002']
+                )
+                for sale in sales:
+                    self.assertIn(sale.state, ('confirmed', 'processing'))
+
+            updated_order_data = dict(
+                load_json('orders', '100000002'),
+                status='complete', updated_at='2013-07-01 10:00:00'
+            )
+
+            def get_order_api():
+                order_api = mock_order_api()
+                handle = order_api.return_value
+                handle.info_multi = MagicMock(side_effect=lambda ids: [
+                    updated_order_data if order_id == '100000002'
+                    else load_json('orders', order_id)
+                    for order_id in ids
+                ])
+                handle.search = MagicMock(return_value={
+                    'items': [{
+                        'increment_id': '100000002',
+                        'updated_at': updated_order_data['updated_at'],
+                    }],
+                    'hasNext': False,
+                })
+                return order_api
+
+            with patch.object(
+                Sale, 'update_order_status_using_magento_data'
+            ) as update_order_status:
+                # All the open orders are fetched by the first update
+                order_api = get_order_api()
+                with patch('magento.Order', order_api, create=True):
+                    self.Channel(self.channel1.id).update_order_status()
+                handle = order_api.return_value
+                self.assertFalse(handle.search.called)
+                self.assertEqual(handle.info_multi.call_count, 1)
+                self.assertEqual(
+                    sorted(handle.info_multi.call_args[0][0]),
+                    ['100000001', '100000002']
+                )
+                self.assertTrue(
+                    self.Channel(
+                        self.channel1.id
+                    ).magento_last_order_status_update_time
+                )
+
+                # Then only the orders updated since the last update
+                update_order_status.reset_mock()
+                order_api = get_order_api()
+                with patch('magento.Order', order_api, create=True):
+                    self.Channel(self.channel1.id).update_order_status()
+                handle = order_api.return_value
+                self.assertEqual(handle.search.call_count, 1)
+                self.assertEqual(
+                    handle.search.call_args[1]['filters']['store_id'],
+                    {'=': self.channel1.magento_store_id}
+                )
+                handle.info_multi.assert_called_once_with(['100000002'])
+                update_order_status.assert_called_once_with(
+                    [sales[1]], [updated_order_data]
+                )
+                # The refreshed orders are not cached
+                self.assertEqual(OrderCache.search([], count=True), 0)
+
+                # The same version of the order fetched by a lookup by
+                # increment id is taken from the cache
+                update_order_status.reset_mock()
+                order_api = get_order_api()
+                order_api.return_value.info = MagicMock(
+                    return_value=updated_order_data
+                )
+                with patch('magento.Order', order_api, create=True):
+                    self.channel1.get_magento_order_data('100000002')
+                    self.Channel(self.channel1.id).update_order_status()
+                handle = order_api.return_value
+                self.assertEqual(handle.search.call_count, 1)
+                self.assertFalse(handle.info_multi.called)
+                update_order_status.assert_called_once_with(
+                    [sales[1]], [updated_order_data]
+                )
+
+    def test_0066_complete_shipments_of_orders_completed_on_magento(self):
+        """
+        Tests that the shipments of the orders completed on magento are
+        processed until done, each transition being run once for all the
+        shipments in the matching state
+        """
+        Sale = POOL.get('sale.sale')
+        Shipment = POOL.get('stock.shipment.out')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                shipment1, shipment2 = self.create_shipments(
+                    ['100000001', '100000002']
+                )
+                Shipment.draft([shipment1])
+                Shipment.assign([shipment2])
+                sale1, = Sale.search([('reference', '=', 'mag_100000001')])
+                sale2, = Sale.search([('reference', '=', 'mag_100000002')])
+
+                order_data1 = load_json('orders', '100000001')
+                order_data2 = load_json('orders', '100000002')
+
+                # Nothing is done for an order which is not complete
+                sale1.update_order_status_from_magento(order_data1)
+                self.assertEqual(Shipment(shipment1.id).state, 'draft')
+
+                with patch.object(
+                    Shipment, 'wait', wraps=Shipment.wait
+                ) as wait, patch.object(
+                    Shipment, 'assign', wraps=Shipment.assign
+                ) as assign, patch.object(
+                    Shipment, 'pack', wraps=Shipment.pack
+                ) as pack, patch.object(
+                    Shipment, 'done', wraps=Shipment.done
+                ) as done:
+                    Sale.update_order_status_using_magento_data(
+                        [sale1, sale2], [
+                            dict(order_data1, status='complete'),
+                            dict(order_data2, status='complete'),
+                        ]
+                    )
+
+                wait.assert_called_once_with([shipment1])
+                assign.assert_called_once_with([shipment1])
+                pack.assert_called_once_with([shipment1, shipment2])
+                done.assert_called_once_with([shipment1, shipment2])
+                self.assertEqual(
+                    [shipment.state for shipment in Shipment.browse(
+                        [shipment1.id, shipment2.id]
+                    )], ['done', 'done']
+                )
 
     def test_0070_export_order_status_with_last_order_export_time_case2(self):
         """
@@ -1133,6 +2183,147 @@ class TestSale(TestBase):
                     datetime.utcnow().date()
                 )
 
+    def test_0125_export_unchanged_tier_prices_to_magento(self):
+        """
+        Tests that tier prices are not exported again when they did not
+        change since the last export
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+        MagentoPriceTier = POOL.get('sale.channel.magento.price_tier')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                order_data = load_json('orders', '100000001')
+
+                with patch(
+                        'magento.Customer', mock_customer_api(), create=True):
+                    self.Party.find_or_create_using_magento_id(
+                        order_data['customer_id']
+                    )
+
+                with Transaction().set_context(company=self.company):
+                    # Create sale order using magento data
+                    with patch(
+                            'magento.Product', mock_product_api(), create=True):
+                        Sale.find_or_create_using_magento_data(order_data)
+
+                MagentoPriceTier.create([{
+                    'channel': self.channel1.id,
+                    'quantity': 10,
+                }])
+
+                with patch(
+                    'magento.ProductTierPrice', mock_tier_price_api(),
+                    create=True
+                ):
+                    self.assertEqual(self.channel1.export_product_prices(), 2)
+
+                    # Export everything again, nothing changed
+                    self.Channel.write([self.channel1], {
+                        'last_product_price_export_time': None,
+                    })
+                    self.assertEqual(self.channel1.export_product_prices(), 0)
+
+    def test_0126_export_tier_prices_after_deletions(self):
+        """
+        Tests that deleting tiers or price list rules selects the listings
+        whose tier prices changed
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+        Product = POOL.get('product.product')
+        Template = POOL.get('product.template')
+        ChannelListing = POOL.get('product.product.channel_listing')
+        ProductPriceTier = POOL.get('product.price_tier')
+        MagentoPriceTier = POOL.get('sale.channel.magento.price_tier')
+        PriceListLine = POOL.get('product.price_list.line')
+
+        def backdate():
+            # Nothing changed since yesterday
+            cursor = Transaction().cursor
+            yesterday = datetime.utcnow() - relativedelta(days=1)
+            for Model in (
+                    self.PriceList, PriceListLine, MagentoPriceTier,
+                    ProductPriceTier, Product, Template, ChannelListing):
+                table = Model.__table__()
+                cursor.execute(*table.update(
+                    [table.create_date, table.write_date],
+                    [yesterday, yesterday]
+                ))
+
+        def changed_listings():
+            since = datetime.utcnow() - relativedelta(hours=1)
+            return ChannelListing.search([
+                ('channel', '=', self.channel1.id),
+                self.channel1.get_magento_price_changes_domain(since),
+            ], order=[('id', 'ASC')])
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                order_data = load_json('orders', '100000001')
+
+                with patch(
+                        'magento.Customer', mock_customer_api(), create=True):
+                    self.Party.find_or_create_using_magento_id(
+                        order_data['customer_id']
+                    )
+
+                with Transaction().set_context(company=self.company):
+                    # Create sale order using magento data
+                    with patch(
+                            'magento.Product', mock_product_api(), create=True):
+                        Sale.find_or_create_using_magento_data(order_data)
+
+                listing1, listing2 = ChannelListing.search([
+                    ('channel', '=', self.channel1.id),
+                ], order=[('id', 'ASC')])
+                product_tier, = ProductPriceTier.create([{
+                    'product_listing': listing1.id,
+                    'quantity': 10,
+                }])
+                channel_tier, = MagentoPriceTier.create([{
+                    'channel': self.channel1.id,
+                    'quantity': 10,
+                }])
+                line, = PriceListLine.create([{
+                    'price_list': self.price_list.id,
+                    'product': listing2.product.id,
+                    'formula': 'unit_price',
+                }])
+
+                backdate()
+                self.assertEqual(changed_listings(), [])
+
+                ProductPriceTier.delete([product_tier])
+                self.assertEqual(changed_listings(), [listing1])
+
+                backdate()
+                MagentoPriceTier.delete([channel_tier])
+                self.assertEqual(changed_listings(), [listing1, listing2])
+
+                backdate()
+                PriceListLine.delete([line])
+                self.assertEqual(changed_listings(), [listing1, listing2])
+
     def test_0110_export_tier_prices_to_magento_using_last_import_time(self):
         """
         Tests if tier prices is exported for the product only which has changed
@@ -1406,6 +2597,188 @@ class TestSale(TestBase):
                 self.assertEqual(payment.amount_available, Decimal('0'))
                 self.assertEqual(len(payment.payment_transactions), 1)
 
+    def test_0131_import_order_batch_posts_payments_at_once(self):
+        """
+        Tests that the payment transactions and the contact mechanisms of a
+        batch of imported orders are processed once the batch is imported
+        """
+        Category = POOL.get('product.category')
+        PaymentGateway = POOL.get('payment_gateway.gateway')
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        MagentoPaymentGateway = POOL.get('magento.instance.payment_gateway')
+        ContactMechanism = POOL.get('party.contact_mechanism')
+        OrderArchive = POOL.get('sale.channel.magento.order_archive')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            cash_gateway, = PaymentGateway.create([{
+                'name': 'Manual Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'self',
+                'method': 'manual',
+            }])
+            MagentoPaymentGateway.create([{
+                'name': 'checkmo',
+                'title': 'checkmo',
+                'gateway': cash_gateway.id,
+                'channel': self.channel1.id,
+            }])
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                order_data = load_json('orders', '300000001-completed-payment')
+
+                with patch(
+                        'magento.Customer', mock_customer_api(), create=True):
+                    self.Party.find_or_create_using_magento_id(
+                        order_data['customer_id']
+                    )
+                OrderArchive.archive_orders_data(self.channel1, [order_data])
+
+                with Transaction().set_context(company=self.company):
+                    with patch(
+                        'magento.Product', mock_product_api(), create=True
+                    ):
+                        with patch.object(
+                            PaymentTransaction, 'post',
+                            wraps=PaymentTransaction.post
+                        ) as post:
+                            sale, = self.channel1.reimport_from_archive()
+
+                payment, = sale.payments
+                post.assert_called_once_with(
+                    list(payment.payment_transactions)
+                )
+                self.assertEqual(payment.amount_available, Decimal('0'))
+
+                self.assertTrue(ContactMechanism.search([
+                    ('party', '=', sale.party.id),
+                    ('type', '=', 'phone'),
+                    ('value', '=', order_data['billing_address']['telephone']),
+                ]))
+
+    def test_0135_magento_payment_gateways(self):
+        """
+        Tests the cache of the payment gateways of a channel and the creation
+        of the missing gateways
+        """
+        PaymentGateway = POOL.get('payment_gateway.gateway')
+        MagentoPaymentGateway = POOL.get('magento.instance.payment_gateway')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            cash_gateway, = PaymentGateway.create([{
+                'name': 'Manual Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'self',
+                'method': 'manual',
+            }])
+            checkmo, = MagentoPaymentGateway.create([{
+                'name': 'checkmo',
+                'title': 'checkmo',
+                'gateway': cash_gateway.id,
+                'channel': self.channel1.id,
+            }])
+
+            def get_values(gateway_data):
+                return {
+                    'name': gateway_data['name'],
+                    'title': gateway_data['title'],
+                    'gateway': cash_gateway.id,
+                    'channel': self.channel1.id,
+                }
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                self.assertEqual(
+                    MagentoPaymentGateway.get_magento_gateways(
+                        self.channel1.id
+                    ), {'checkmo': checkmo.id}
+                )
+
+                # The gateways are read from the cache
+                with patch.object(MagentoPaymentGateway, 'search') as search:
+                    gateway = MagentoPaymentGateway.find_using_magento_data({
+                        'name': 'checkmo',
+                    })
+                    self.assertFalse(search.called)
+                self.assertEqual(gateway, checkmo)
+
+                # Changing a gateway clears the cache
+                MagentoPaymentGateway.write([checkmo], {'name': 'checkmo2'})
+                self.assertIsNone(
+                    MagentoPaymentGateway.find_using_magento_data({
+                        'name': 'checkmo',
+                    })
+                )
+                self.assertEqual(
+                    MagentoPaymentGateway.find_using_magento_data({
+                        'name': 'checkmo2',
+                    }), checkmo
+                )
+
+                # The missing gateways are created at once
+                with patch.object(
+                    MagentoPaymentGateway, 'get_values_using_magento_data',
+                    side_effect=get_values
+                ):
+                    with patch.object(
+                        MagentoPaymentGateway, 'create',
+                        wraps=MagentoPaymentGateway.create
+                    ) as create:
+                        gateways = \
+                            MagentoPaymentGateway.create_all_using_magento_data(
+                                [
+                                    {'name': 'checkmo2', 'title': 'Check'},
+                                    {'name': 'ccsave', 'title': 'Card'},
+                                    {'name': 'paypal', 'title': 'Paypal'},
+                                    {'name': 'ccsave', 'title': 'Card'},
+                                ]
+                            )
+                        self.assertEqual(create.call_count, 1)
+                self.assertEqual(
+                    [record.name for record in gateways],
+                    ['checkmo2', 'ccsave', 'paypal', 'ccsave']
+                )
+                self.assertEqual(gateways[0], checkmo)
+                self.assertEqual(gateways[1], gateways[3])
+                self.assertEqual(
+                    MagentoPaymentGateway.search([], count=True), 3
+                )
+
+                # Without the values, the gateways are created one by one
+                with patch.object(
+                    MagentoPaymentGateway, 'create_using_magento_data',
+                    side_effect=lambda gateway_data:
+                        MagentoPaymentGateway.create([
+                            get_values(gateway_data)
+                        ])[0]
+                ) as create_using_magento_data:
+                    gateway, = \
+                        MagentoPaymentGateway.create_all_using_magento_data([
+                            {'name': 'banktransfer', 'title': 'Bank'},
+                        ])
+                    self.assertEqual(create_using_magento_data.call_count, 1)
+                self.assertEqual(gateway.name, 'banktransfer')
+                self.assertEqual(
+                    MagentoPaymentGateway.get_magento_gateways(
+                        self.channel1.id
+                    ), {
+                        'checkmo2': checkmo.id,
+                        'ccsave': gateways[1].id,
+                        'paypal': gateways[2].id,
+                        'banktransfer': gateway.id,
+                    }
+                )
+
     def test_140_check_date_conversion_est_to_utc(self):
         """
         Tests conversion of date in case user selects a timezone